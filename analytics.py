@@ -0,0 +1,94 @@
+'''
+Portfolio analytics computed column-wise over a user's history.
+
+Trades are loaded into a pandas frame once and pivoted to day-by-symbol
+arrays, from which positions, market value, cash, equity, returns,
+drawdown and each symbol's contribution to profit follow as whole-array
+operations. Positions are marked at the last traded price of each symbol
+until the latest shared price, which marks the final day. Cash before a
+trade is reconstructed from the user's current cash, so money added with
+/add counts as if it was there from the start.
+
+Needs numpy and pandas, which the rest of the app doesn't.
+'''
+
+import os
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Most users whose results are kept
+ANALYTICS_CACHE_SIZE = int(os.environ.get("ANALYTICS_CACHE_SIZE", 256))
+
+# Results by user id, as (key, result) pairs, least recently used first
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+def analyze(db, user_id, key):
+    """Return the user's analytics, recomputing them only when key has changed since the last call."""
+    with _lock:
+        cached = _results.get(user_id)
+        if cached and cached[0] == key:
+            _results.move_to_end(user_id)
+            return cached[1]
+
+    result = compute(db, user_id)
+    with _lock:
+        _results[user_id] = (key, result)
+        _results.move_to_end(user_id)
+        while len(_results) > ANALYTICS_CACHE_SIZE:
+            _results.popitem(last=False)
+    return result
+
+
+def compute(db, user_id):
+    """Return daily equity, returns and drawdown, and per-symbol profit, from the user's history."""
+    trades = pd.DataFrame(db.execute("SELECT Date, Symbol, Shares, Price, [Transaction] FROM history WHERE user_id = ? ORDER BY Date, id",
+                                     user_id), columns=["Date", "Symbol", "Shares", "Price", "Transaction"])
+    cash_now = float(db.execute("SELECT cash FROM users WHERE id = ?", user_id)[0]["cash"])
+    if trades.empty:
+        return {"dates": [], "equity": [], "returns": [], "drawdown": [], "max_drawdown": 0.0, "symbols": {}}
+
+    # Signed share counts and cash flows of every trade, bucketed by day
+    trades["Day"] = pd.to_datetime(trades["Date"]).dt.normalize()
+    trades["Price"] = trades["Price"].astype(float)
+    trades["Signed"] = np.where(trades["Transaction"] == "Sale", -1, 1) * trades["Shares"].astype(float)
+    trades["Flow"] = -trades["Signed"] * trades["Price"]
+    days = pd.date_range(trades["Day"].iloc[0], max(trades["Day"].iloc[-1], pd.Timestamp.now(tz="UTC").tz_localize(None).normalize()))
+
+    # Day-by-symbol positions, marks and cumulative cash flows
+    positions = trades.pivot_table(index="Day", columns="Symbol", values="Signed", aggfunc="sum").reindex(days, fill_value=0).fillna(0).cumsum()
+    flows = trades.pivot_table(index="Day", columns="Symbol", values="Flow", aggfunc="sum").reindex(days, fill_value=0).fillna(0).cumsum()
+    marks = trades.groupby(["Day", "Symbol"])["Price"].last().unstack().reindex(days).ffill()
+    symbols = list(positions.columns)
+    placeholders = ", ".join("?" * len(symbols))
+    for row in db.execute(f"SELECT Symbol, Price FROM prices WHERE Symbol IN ({placeholders})", *symbols):
+        marks.iloc[-1, marks.columns.get_loc(row["Symbol"])] = float(row["Price"])
+    marks = marks[symbols].fillna(0)
+
+    # Value of positions, cash and equity each day
+    values = positions * marks
+    value = values.sum(axis=1).to_numpy()
+    flow = flows.sum(axis=1).to_numpy()
+    cash = cash_now - (flow[-1] - flow)
+    equity = cash + value
+    returns = np.divide(np.diff(equity), equity[:-1], out=np.zeros(len(equity) - 1), where=equity[:-1] != 0)
+    peak = np.maximum.accumulate(equity)
+    drawdown = np.divide(equity, peak, out=np.ones_like(equity), where=peak != 0) - 1
+
+    # Profit each symbol has made, realized and unrealized, and its share of the return on starting equity
+    profit = (values + flows).iloc[-1]
+    return {
+        "dates": [day.strftime("%Y-%m-%d") for day in days],
+        "equity": np.round(equity, 2).tolist(),
+        "returns": np.round(returns, 6).tolist(),
+        "drawdown": np.round(drawdown, 6).tolist(),
+        "max_drawdown": round(float(drawdown.min()), 6),
+        "symbols": {symbol: {"profit": round(float(profit[symbol]), 2),
+                             "contribution": round(float(profit[symbol] / equity[0]), 6) if equity[0] else 0.0}
+                    for symbol in symbols}
+    }
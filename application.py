@@ -1,49 +1,136 @@
 '''Edited by Kiron Deb'''
 
+import csv
+import functools
+import io
+import json
+import math
 import os
 import re
+import time
 
-from cs50 import SQL
-from flask import Flask, flash, jsonify, redirect, render_template, request, session
+from cachelib import SimpleCache
+from flask import Flask, Response, flash, g, jsonify, redirect, render_template, request, session, stream_with_context, url_for
 from flask_session import Session
-from tempfile import mkdtemp
+from markupsafe import Markup
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import check_password_hash, generate_password_hash
-from time import gmtime, strftime
-from helpers import apology, login_required, lookup, usd
+import database
+import instrumentation
+import migrations
+import orders
+import pricehistory
+import refresher
+from helpers import apology, login_required, lookup, lookup_many, normalize_symbol, quote_cache, rate_limit, save_prices, transaction, usd
 
 # Configure application
 app = Flask(__name__)
 
-# Ensure templates are auto-reloaded
-app.config["TEMPLATES_AUTO_RELOAD"] = True
+# Take the client's address from the X-Forwarded-For header set by this many proxies in front of the app
+# (Heroku's router is one), so per-address rate limits don't lump every client together; set
+# TRUSTED_PROXIES=0 when clients connect directly, so they can't choose their own address
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get("TRUSTED_PROXIES", 1)))
 
-# Ensure responses aren't cached
+# Reload edited templates only in debug mode or with TEMPLATES_AUTO_RELOAD=1, since checking for edits stats them on every render
+app.config["TEMPLATES_AUTO_RELOAD"] = os.environ.get("TEMPLATES_AUTO_RELOAD") == "1" or None
+
+# Format money in templates
+app.jinja_env.filters["usd"] = usd
+
+# Whether /stream/portfolio is served, which only asgi:app does, so pages served by WSGI alone don't poll it in vain
+app.config["STREAMING"] = False
+
+# Let browsers keep static files for a year, since their URLs change whenever they do
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 365 * 24 * 60 * 60
+
+# Ensure responses aren't cached, except static files and API responses clients revalidate by ETag
 @app.after_request
 def after_request(response):
+    if request.endpoint == "static":
+        return response
+    if request.path.startswith("/api/"):
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
     return response
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
 
-# Configure CS50 Library to use SQLite database
+@app.template_global()
+@functools.lru_cache()
+def static_url(filename):
+    """Return URL of static file, versioned by its modification time."""
+    version = int(os.path.getmtime(os.path.join(app.static_folder, filename)))
+    return url_for("static", filename=filename, v=version)
+
+# Report time spent in the database and quote provider for every request
+instrumentation.init_app(app)
+
+# Configure session to use signed cookies, so any worker can serve any request, or a shared
+# key-value store ("redis", or "memory" as an in-process stand-in for tests)
+app.config["SESSION_PERMANENT"] = False
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+session_backend = os.environ.get("SESSION_BACKEND", "cookie")
+if session_backend == "cookie":
+    if not os.environ.get("SECRET_KEY"):
+        raise RuntimeError("SECRET_KEY not set")
+    app.secret_key = os.environ.get("SECRET_KEY")
+elif session_backend == "redis":
+    import redis
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+    Session(app)
+elif session_backend == "memory":
+    app.config["SESSION_TYPE"] = "cachelib"
+    app.config["SESSION_CACHELIB"] = SimpleCache()
+    Session(app)
+else:
+    raise RuntimeError(f"unknown SESSION_BACKEND: {session_backend}")
+
+# Configure a pool of connections to the SQLite or Postgres database
 uri = os.getenv("DATABASE_URL") 
 if uri and uri.startswith("postgres://"):
     uri = uri.replace("postgres://", "postgresql://", 1)
-db = SQL(uri)
+db = instrumentation.InstrumentedSQL(database.Database(uri, pool_size=int(os.environ.get("DATABASE_POOL_SIZE", 5)),
+                                                       max_overflow=int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))))
 
-# Make sure API key is set
-if not os.environ.get("API_KEY"):
+# Bring the schema up to date
+migrations.migrate(db, db.dialect)
+
+# Make sure API key is set when quotes come from IEX
+if os.environ.get("QUOTE_PROVIDER", "iex") == "iex" and not os.environ.get("API_KEY"):
     raise RuntimeError("API_KEY not set")
 
-# Store username of the user currently logged in
-username = ""
+# Optionally keep the shared prices fresh from a thread in this process (or run refresher.py as a worker)
+if os.environ.get("PRICE_REFRESHER") == "thread":
+    refresher.start(db, float(os.environ.get("PRICE_REFRESH_INTERVAL", 60)))
+
+# Write the price history of quotes this process fetches every few seconds
+pricehistory.start(db, float(os.environ.get("PRICE_HISTORY_FLUSH_INTERVAL", 10)))
+
+# Rows of history shown per page, and fetched per query when exporting
+HISTORY_PAGE_SIZE = 50
+EXPORT_CHUNK_SIZE = 500
+
+# Rendered pages of history tables, keyed by user, newest trade and page, so unchanged pages aren't rendered again
+history_tables = SimpleCache(threshold=int(os.environ.get("HISTORY_CACHE_SIZE", 500)), default_timeout=0)
+
+# Most legs in one basket order
+BASKET_MAX_LEGS = 100
+
+# Bars of each period returned by default, and at most, per symbol, and most symbols per request
+BARS_DEFAULT_COUNT = {"1m": 24 * 60, "1d": 365}
+BARS_MAX_COUNT = 5000
+BARS_MAX_SYMBOLS = 100
+
+# Requests a second, and bursts, allowed per user on routes that look up quotes or trade,
+# and per client address on form submissions that check passwords or create users
+QUOTE_LIMIT = (1, 10)
+TRADE_LIMIT = (2, 20)
+UPDATE_LIMIT = (0.2, 3)
+LOGIN_LIMIT = (0.2, 5)
 
 @app.route("/")
 @login_required
@@ -51,32 +138,30 @@ def index():
     """Show portfolio of stocks"""
 
     # Get records of current user
-    rows = db.execute("SELECT Symbol, Name, Shares, Price, Total FROM purchases WHERE user_name=? ORDER BY Symbol", username)
+    rows = holdings(g.user_id)
 
-    # Get cash balance
-    cash = db.execute("SELECT cash FROM users WHERE username = ?", username)
+    # Get cash balance and the value, cost and realized gain of all positions
+    totals = portfolio_totals(g.user_id)
 
-    # Store the total assets by adding cash on hand to the value of all owned shares
-    total_assets = float(cash[0]["cash"])
-    for row in rows:
-        total_assets += float(row["Total"])
-
-    return render_template("portfolio.html", rows=rows, cash_on_hand=round(cash[0]["cash"], 2), total_assets = round(total_assets, 2))
+    return render_template("portfolio.html", rows=rows, cash_on_hand=round(totals["cash"], 2),
+                           total_assets=round(totals["cash"] + totals["value"], 2),
+                           unrealized=round(totals["value"] - totals["cost"], 2), realized=round(totals["realized"], 2))
 
 @app.route("/update", methods=["GET", "POST"])
 @login_required
+@rate_limit(*UPDATE_LIMIT)
 def update():
     """Update all stock prices"""
 
     # Get symbols of all owned stocks
-    symbols = db.execute("SELECT Symbol, Shares, Total FROM purchases WHERE user_name = ?", username)
+    symbols = db.execute("SELECT Symbol FROM purchases WHERE user_id = ? AND Shares > 0", g.user_id)
+
+    # Fetch every price in one batched round trip
+    quotes = lookup_many([row["Symbol"] for row in symbols])
 
-    # Update share price and total stock value for each symbol
-    for row in symbols:
-        stock = lookup(row["Symbol"])
-        stock_price = round(float(stock["price"]), 2)
-        new_total = stock_price*row["Shares"]
-        db.execute("UPDATE purchases SET Price = ?, Total = ? WHERE user_name = ? AND Symbol = ?", stock_price, new_total, username, row["Symbol"])
+    # Store new prices, shared by everyone holding these symbols, in one transaction
+    with transaction(db):
+        save_prices(db, quotes.values())
 
     return redirect("/")
 
@@ -86,9 +171,10 @@ def reset():
     """Remove all user transactions"""
 
     # Delete user records from database and set cash to default value
-    db.execute("DELETE FROM purchases WHERE user_name = ?", username)
-    db.execute("DELETE FROM history WHERE user = ?", username)
-    db.execute("UPDATE users SET cash = ? WHERE username = ?", 10000, username)
+    db.execute("DELETE FROM purchases WHERE user_id = ?", g.user_id)
+    db.execute("DELETE FROM history WHERE user_id = ?", g.user_id)
+    orders.cancel_all(db, g.user_id)
+    db.execute("UPDATE users SET cash = ?, version = version + 1 WHERE id = ?", 10000, g.user_id)
 
     return redirect("/")
 
@@ -108,11 +194,12 @@ def add():
         # How much cash user wishes to add
         to_add = request.form.get("injection")
 
-        db.execute("UPDATE users SET cash = cash + ? WHERE username = ?", to_add, username)
+        db.execute("UPDATE users SET cash = cash + ?, version = version + 1 WHERE id = ?", to_add, g.user_id)
         return redirect("/")
 
 @app.route("/buy", methods=["GET", "POST"])
 @login_required
+@rate_limit(*TRADE_LIMIT)
 def buy():
     """Buy shares of stock"""
 
@@ -128,42 +215,15 @@ def buy():
         if shares <= 0:
             return apology("invalid number of shares, 403")
 
-        # Get stock data from lookup
-        company_name = stock["name"]
-        company_symbol = stock["symbol"]
-        stock_price = round(float(stock["price"]), 2)
-
-        # Get cash on hand
-        retrieve_balance = db.execute("SELECT cash FROM users WHERE username=?", username)
-        balance = retrieve_balance[0]["cash"]
-
-        # Calculate total value of shares bought
-        loss = round(shares*stock_price, 2)
-
-        # Return apology if cash on hand insufficient
-        if balance < loss:
-            return apology("can't afford")
-
-        # Get date and time for transaction
-        datetime = strftime("%Y-%m-%d %H:%M:%S", gmtime())
-
-        # Add record for transaction to history
-        db.execute("INSERT INTO history(Date, User, Symbol, Shares, Price, [Transaction]) VALUES (?, ?, ?, ?, ?, ?)", datetime, username, company_symbol, shares, stock_price, 'Purchase')
-
-        # Query to check if user already bought shares from this company
-        owned = db.execute("SELECT Shares, Total FROM purchases WHERE Symbol=? AND user_name=?", company_symbol, username)
-
-        # Update existing record if user already bought this company's shares
-        if owned:
-            total_shares = shares + int(owned[0]["Shares"])
-            db.execute("UPDATE purchases SET Price = ?, Shares = ?, Total = ? WHERE Symbol = ? AND user_name = ?", stock_price, total_shares, round(total_shares*float(stock_price), 2 ), company_symbol, username)
-
-        # Add new record if user hasn't bought this company's shares
-        else:
-            db.execute("INSERT INTO purchases(user_name, Symbol, Name, Shares, Price, Total) VALUES (?, ?, ?, ?, ?, ?)", username, company_symbol, company_name, shares, stock_price, loss)
+        # Don't trade at a price served from cache while the quote provider is down
+        if stock.get("stale"):
+            return apology("quotes unavailable, try again later", 503)
 
-        # Update cash on hand by deducting total value of shares bought
-        db.execute("UPDATE users SET cash = cash - ? WHERE username = ?", loss, username)
+        # Execute order, which fails if cash on hand is insufficient
+        try:
+            orders.buy(db, g.user_id, stock, shares)
+        except orders.OrderError as e:
+            return apology(str(e))
         return redirect("/")
 
 
@@ -172,12 +232,102 @@ def buy():
 def history():
     """Show history of transactions"""
 
-    # Query for user's records in history
-    hist_data = db.execute("SELECT Symbol, Shares, Price, Date, [Transaction] FROM history WHERE user=? ORDER BY Date DESC", username)
-    return render_template("history.html", data = hist_data)
+    # Resume after the last row of the previous page, if any
+    cursor = None
+    if request.args.get("date") and request.args.get("id", "").isdigit():
+        cursor = (request.args.get("date"), int(request.args.get("id")))
+
+    # Reuse this page's table if the user hasn't traded since it was rendered; trades are only ever
+    # appended, with ids that are never reused, so the newest trade's id changes with every trade
+    newest = db.execute("SELECT id FROM history WHERE user_id = ? ORDER BY Date DESC, id DESC LIMIT 1", g.user_id)
+    key = f"{g.user_id}:{newest[0]['id'] if newest else 0}:{cursor}"
+    table = history_tables.get(key)
+    if table is None:
+
+        # Query for one page of user's records in history, plus one row to tell whether there's another page
+        hist_data = history_page(g.user_id, cursor, HISTORY_PAGE_SIZE + 1)
+        next_page = None
+        if len(hist_data) > HISTORY_PAGE_SIZE:
+            hist_data = hist_data[:HISTORY_PAGE_SIZE]
+            next_page = {"date": hist_data[-1]["Date"], "id": hist_data[-1]["id"]}
+        table = render_template("history_table.html", data = hist_data, next_page = next_page)
+        history_tables.set(key, table)
+    return render_template("history.html", table = Markup(table))
+
+
+@app.route("/history/export")
+@login_required
+def history_export():
+    """Download full history of transactions as CSV or JSON"""
+
+    # Capture user now, since the response is generated after this view returns
+    user_id = g.user_id
+    fields = ["Date", "Transaction", "Symbol", "Shares", "Price"]
+
+    def rows():
+        """Yield every history row, newest first, fetching one keyset page at a time."""
+        cursor = None
+        while True:
+            page = history_page(user_id, cursor, EXPORT_CHUNK_SIZE)
+            yield from page
+            if len(page) < EXPORT_CHUNK_SIZE:
+                return
+            cursor = (page[-1]["Date"], page[-1]["id"])
+
+    if request.args.get("format") == "json":
+        def generate():
+            yield "["
+            for i, row in enumerate(rows()):
+                yield ("," if i else "") + json.dumps({field: float(row[field]) if field == "Price" else row[field] for field in fields})
+            yield "]"
+        mimetype, extension = "application/json", "json"
+    else:
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(fields)
+            for i, row in enumerate(rows(), 1):
+                writer.writerow([row[field] for field in fields])
+                if i % EXPORT_CHUNK_SIZE == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        mimetype, extension = "text/csv", "csv"
+
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=history.{extension}"})
+
+
+def holdings(user_id):
+    """Return the user's open positions, valued at the latest shared price of each symbol."""
+    return db.execute("SELECT purchases.Symbol AS Symbol, prices.Name AS Name, Shares, Cost, 1.0 * Cost / Shares AS AverageCost, Realized, "
+                      "prices.Price AS Price, Shares * prices.Price AS Total "
+                      "FROM purchases JOIN prices ON prices.Symbol = purchases.Symbol WHERE user_id = ? AND Shares > 0 "
+                      "ORDER BY purchases.Symbol", user_id)
+
+
+def portfolio_totals(user_id):
+    """Return the user's cash and the summed value, cost basis and realized gain of their positions."""
+    row = db.execute("SELECT cash, COALESCE(SUM(Shares * prices.Price), 0) AS value, COALESCE(SUM(Cost), 0) AS cost, "
+                     "COALESCE(SUM(Realized), 0) AS realized FROM users "
+                     "LEFT JOIN purchases ON purchases.user_id = users.id LEFT JOIN prices ON prices.Symbol = purchases.Symbol "
+                     "WHERE users.id = ? GROUP BY users.id, cash", user_id)[0]
+    return {key: float(value) for key, value in row.items()}
+
+
+def history_page(user_id, cursor, limit):
+    """Return up to limit of the user's history rows, newest first, that come after cursor's (Date, id)."""
+    if not cursor:
+        return db.execute("SELECT id, Symbol, Shares, Price, Date, [Transaction] FROM history WHERE user_id = ? "
+                          "ORDER BY Date DESC, id DESC LIMIT ?", user_id, limit)
+    date, last_id = cursor
+    return db.execute("SELECT id, Symbol, Shares, Price, Date, [Transaction] FROM history WHERE user_id = ? AND (Date < ? OR (Date = ? AND id < ?)) "
+                      "ORDER BY Date DESC, id DESC LIMIT ?", user_id, date, date, last_id, limit)
 
 
 @app.route("/login", methods=["GET", "POST"])
+@rate_limit(*LOGIN_LIMIT, methods=("POST",))
 def login():
     """Log user in"""
 
@@ -206,10 +356,6 @@ def login():
         # Remember which user has logged in
         session["user_id"] = rows[0]["id"]
 
-        # Remember username
-        global username
-        username = request.form.get("username")
-
         # Redirect user to home page
         return redirect("/")
 
@@ -231,6 +377,7 @@ def logout():
 
 @app.route("/quote", methods=["GET", "POST"])
 @login_required
+@rate_limit(*QUOTE_LIMIT)
 def quote():
     """Get stock quote."""
 
@@ -250,11 +397,14 @@ def quote():
 
         # Format output string
         output = f'{company_name} ({company_symbol}) stock price: {stock_price}'
+        if stock.get("stale"):
+            output += " (delayed)"
 
         return render_template("quoted.html", message=output)
 
 
 @app.route("/register", methods=["GET", "POST"])
+@rate_limit(*LOGIN_LIMIT, methods=("POST",))
 def register():
     """Register user"""
     if request.method == "GET":
@@ -289,14 +439,13 @@ def register():
 
 @app.route("/sell", methods=["GET", "POST"])
 @login_required
+@rate_limit(*TRADE_LIMIT)
 def sell():
     """Sell shares of stock"""
 
-    # Get symbols and counts of shares owned
-    shares_owned = db.execute("SELECT Symbol, Shares FROM purchases WHERE user_name = ?", username)
-
     if request.method == "GET":
         # Displays a dropdown containing symbols of all owned shares
+        shares_owned = db.execute("SELECT Symbol, Shares FROM purchases WHERE user_id = ? AND Shares > 0", g.user_id)
         return render_template("sell.html", owned = shares_owned)
 
     else:
@@ -310,50 +459,268 @@ def sell():
         num_to_sell = int(request.form.get("shares"))
         symb = request.form.get("symbol")
 
-        # Check for erroneous input
-        if not num_to_sell or num_to_sell <= 0:
-            return apology("Must sell 1 or more shares", 403)
-        if not symb:
-            return apology("No symbol selected", 403)
-
         # Get stock data from lookup
         stock = lookup(symb)
-        company_name = stock["name"]
-        company_symbol = stock["symbol"]
-        stock_price = stock["price"]
+        if not stock:
+            return apology("invalid symbol, 403")
+        if stock.get("stale"):
+            return apology("quotes unavailable, try again later", 503)
+
+        # Execute order, which fails if user doesn't own enough shares
+        try:
+            orders.sell(db, g.user_id, stock, num_to_sell)
+        except orders.OrderError as e:
+            return apology(str(e), 403)
+
+        # Redirect to home page to display portfolio
+        return redirect("/")
 
-        # Get number of shares already owned
-        no_owned = db.execute("SELECT Shares FROM purchases WHERE user_name = ? AND Symbol = ?", username, company_symbol)
+@app.route("/api/v1/portfolio")
+@login_required
+def api_portfolio():
+    """Get portfolio of stocks as JSON"""
+
+    # Answer a client that already has this version of the portfolio without building it again
+    etag = portfolio_etag(g.user_id)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    rows = holdings(g.user_id)
+    totals = portfolio_totals(g.user_id)
+    response = jsonify({
+        "cash": round(totals["cash"], 2),
+        "holdings": [{"symbol": row["Symbol"], "name": row["Name"], "shares": row["Shares"], "cost": round(float(row["Cost"]), 2),
+                      "average_cost": round(float(row["AverageCost"]), 2), "price": round(float(row["Price"]), 2),
+                      "total": round(float(row["Total"]), 2), "unrealized": round(float(row["Total"]) - float(row["Cost"]), 2),
+                      "realized": round(float(row["Realized"]), 2)} for row in rows],
+        "total": round(totals["cash"] + totals["value"], 2),
+        "unrealized": round(totals["value"] - totals["cost"], 2),
+        "realized": round(totals["realized"], 2)
+    })
+    response.set_etag(etag)
+    return response
 
-        # Apologies for invalid input
-        if num_to_sell <= 0:
-            return apology("Must sell 1 or more shares!", 403)
-        elif int(no_owned[0]["Shares"]) < num_to_sell:
-            return apology("You don't own that many shares of the company!", 403)
 
-        # If selling all owned shares then delete record
-        if int(no_owned[0]["Shares"]) == num_to_sell:
-            db.execute("DELETE FROM purchases WHERE symbol = ? AND user_name = ?", company_symbol, username)
+@app.route("/api/v1/quote/<symbol>")
+@login_required
+@rate_limit(*QUOTE_LIMIT)
+def api_quote(symbol):
+    """Get stock quote as JSON"""
+    stock = lookup(symbol)
+    if not stock:
+        return api_error("invalid symbol", 404)
+    return jsonify(stock)
+
 
+@app.route("/api/v1/orders", methods=["GET", "POST"])
+@login_required
+@rate_limit(*TRADE_LIMIT)
+def api_orders():
+    """List executed orders, or place a market, limit or stop order, as JSON"""
+
+    if request.method == "GET":
+        # Page through history newest first, like /history
+        cursor = None
+        if request.args.get("date") and request.args.get("id", "").isdigit():
+            cursor = (request.args.get("date"), int(request.args.get("id")))
+        rows = history_page(g.user_id, cursor, HISTORY_PAGE_SIZE + 1)
+        next_page = None
+        if len(rows) > HISTORY_PAGE_SIZE:
+            rows = rows[:HISTORY_PAGE_SIZE]
+            next_page = {"date": rows[-1]["Date"], "id": rows[-1]["id"]}
+        return jsonify({
+            "orders": [{"id": row["id"], "date": row["Date"], "side": "buy" if row["Transaction"] == "Purchase" else "sell",
+                        "symbol": row["Symbol"], "shares": row["Shares"], "price": float(row["Price"])} for row in rows],
+            "next": next_page
+        })
+
+    # Check for invalid input
+    order = request.get_json(silent=True)
+    if not isinstance(order, dict):
+        return api_error("body must be a JSON object", 400)
+    side = order.get("side")
+    shares = order.get("shares")
+    if side not in ("buy", "sell"):
+        return api_error("side must be buy or sell", 400)
+    if not isinstance(shares, int) or isinstance(shares, bool) or shares <= 0:
+        return api_error("shares must be a positive integer", 400)
+    stock = lookup(order.get("symbol"))
+    if not stock:
+        return api_error("invalid symbol", 404)
+
+    # Rest limit and stop orders until a price tick triggers them
+    kind = order.get("type", "market")
+    if kind in ("limit", "stop"):
+        price = order.get("price")
+        if not isinstance(price, (int, float)) or isinstance(price, bool) or not math.isfinite(price) or price <= 0:
+            return api_error("price must be a positive number", 400)
+        order_id = orders.place(db, g.user_id, side, kind, stock, shares, price)
+        return jsonify({"id": order_id, "side": side, "type": kind, "symbol": stock["symbol"], "shares": shares,
+                        "price": round(float(price), 2), "status": "open"}), 201
+    if kind != "market":
+        return api_error("type must be market, limit or stop", 400)
+    if stock.get("stale"):
+        return api_error("quotes unavailable, try again later", 503)
+
+    # Execute order
+    try:
+        if side == "buy":
+            amount = orders.buy(db, g.user_id, stock, shares)
         else:
-            # Update total value of shares owned
-            new_total = (int(no_owned[0]["Shares"]) - num_to_sell)*float(stock_price)
+            amount = orders.sell(db, g.user_id, stock, shares)
+    except orders.OrderError as e:
+        return api_error(str(e), 403)
+    return jsonify({"side": side, "symbol": stock["symbol"], "shares": shares,
+                    "price": round(float(stock["price"]), 2), "amount": amount}), 201
 
-            # Update number of shares owned, current share price and total value of shares owned
-            db.execute("UPDATE purchases SET Shares = Shares - ?, Price = ?, Total = ? WHERE Symbol = ? AND user_name = ?", num_to_sell, stock_price, new_total, company_symbol, username)
 
-        # Update cash by adding value of shares sold
-        gain = float(stock_price)*num_to_sell
-        db.execute("UPDATE users SET cash = cash + ? WHERE username = ?", gain, username)
+@app.route("/api/v1/orders/basket", methods=["POST"])
+@login_required
+@rate_limit(*TRADE_LIMIT)
+def api_basket():
+    """Execute several market orders at once as JSON, all or none"""
+
+    # Check for invalid input
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return api_error("body must be a JSON object", 400)
+    legs = body.get("legs")
+    if not isinstance(legs, list) or not legs or not all(isinstance(leg, dict) for leg in legs):
+        return api_error("legs must be a list of orders", 400)
+    if len(legs) > BASKET_MAX_LEGS:
+        return api_error(f"at most {BASKET_MAX_LEGS} legs per basket", 400)
+    symbols = []
+    for leg in legs:
+        shares = leg.get("shares")
+        if leg.get("side") not in ("buy", "sell"):
+            return api_error("side must be buy or sell", 400)
+        if not isinstance(shares, int) or isinstance(shares, bool) or shares <= 0:
+            return api_error("shares must be a positive integer", 400)
+        if not isinstance(leg.get("symbol"), str) or not normalize_symbol(leg["symbol"]):
+            return api_error("symbol must be a non-empty string", 400)
+        symbols.append(normalize_symbol(leg["symbol"]))
+    if len(set(symbols)) < len(symbols):
+        return api_error("each symbol may appear only once in a basket", 400)
+
+    # Price every leg in one batched round trip
+    quotes = lookup_many(symbols)
+    stocks = [quotes.get(symbol) for symbol in symbols]
+    if not all(stocks):
+        return api_error("invalid symbol", 404)
+    if any(stock.get("stale") for stock in stocks):
+        return api_error("quotes unavailable, try again later", 503)
+
+    # Execute all legs in one transaction
+    try:
+        net = orders.basket(db, g.user_id, [(leg["side"], stock, leg["shares"]) for leg, stock in zip(legs, stocks)])
+    except orders.OrderError as e:
+        return api_error(str(e), 403)
+    return jsonify({
+        "legs": [{"side": leg["side"], "symbol": stock["symbol"], "shares": leg["shares"], "price": round(float(stock["price"]), 2),
+                  "amount": round(leg["shares"] * round(float(stock["price"]), 2), 2)} for leg, stock in zip(legs, stocks)],
+        "cash": net
+    }), 201
+
+
+@app.route("/api/v1/orders/open")
+@login_required
+def api_open_orders():
+    """List resting limit and stop orders as JSON"""
+    rows = db.execute("SELECT id, Symbol, Side, Kind, Shares, TriggerPrice, Placed FROM open_orders "
+                      "WHERE user_id = ? AND Status = 'open' ORDER BY id", g.user_id)
+    return jsonify({"orders": [{"id": row["id"], "side": row["Side"], "type": row["Kind"], "symbol": row["Symbol"],
+                                "shares": row["Shares"], "price": float(row["TriggerPrice"]), "placed": row["Placed"]} for row in rows]})
 
-        # Format date and time for ouput
-        datetime = strftime("%Y-%m-%d %H:%M:%S", gmtime())
 
-        # Add record for transaction to history
-        db.execute("INSERT INTO history(Date, User, Symbol, Shares, Price, [Transaction]) VALUES (?, ?, ?, ?, ?, ?)", datetime, username, company_symbol, num_to_sell, stock_price, 'Sale')
+@app.route("/api/v1/orders/<int:order_id>", methods=["DELETE"])
+@login_required
+def api_cancel_order(order_id):
+    """Cancel a resting order"""
+    if not orders.cancel(db, g.user_id, order_id):
+        return api_error("no such open order", 404)
+    return Response(status=204)
+
+
+@app.route("/api/v1/analytics")
+@login_required
+def api_analytics():
+    """Get daily equity, returns, drawdown and per-symbol profit as JSON"""
+
+    # Analytics need numpy and pandas, which are optional
+    try:
+        import analytics
+    except ImportError:
+        return api_error("analytics unavailable", 501)
+
+    # Answer a client that already has these results, and recompute them only after a trade or price update
+    etag = portfolio_etag(g.user_id)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    response = jsonify(analytics.analyze(db, g.user_id, etag))
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/api/v1/bars")
+@login_required
+def api_bars():
+    """Get 1-minute or 1-day OHLC bars of the given symbols, or else of every held symbol, as JSON"""
+
+    # Default to the most recent bars, including the one still open
+    period = request.args.get("period", "1m")
+    if period not in pricehistory.PERIODS:
+        return api_error("period must be 1m or 1d", 400)
+    seconds = pricehistory.PERIODS[period]
+    try:
+        end = int(request.args.get("end", int(time.time()) + 1))
+        start = int(request.args.get("start", end - seconds * BARS_DEFAULT_COUNT[period]))
+    except ValueError:
+        return api_error("start and end must be Unix times", 400)
+    if not 0 < end - start <= seconds * BARS_MAX_COUNT:
+        return api_error(f"start must be before end, by at most {BARS_MAX_COUNT} bars", 400)
+
+    # Chart the requested symbols, or every symbol the user holds
+    if request.args.get("symbol"):
+        symbols = list(dict.fromkeys(map(normalize_symbol, request.args.getlist("symbol"))))
+        if None in symbols:
+            return api_error("invalid symbol", 404)
+        if len(symbols) > BARS_MAX_SYMBOLS:
+            return api_error(f"at most {BARS_MAX_SYMBOLS} symbols per request", 400)
+    else:
+        symbols = [row["Symbol"] for row in db.execute("SELECT Symbol FROM purchases WHERE user_id = ? AND Shares > 0 ORDER BY Symbol", g.user_id)]
+    return jsonify({"period": period, "start": start, "end": end, "bars": pricehistory.bars(db, symbols, seconds, start, end)})
+
+
+@app.route("/metrics")
+def metrics():
+    """Expose request, database, quote provider and cache counters to Prometheus."""
+    return Response(instrumentation.render(quote_cache.stats()), mimetype="text/plain; version=0.0.4")
+
+
+def portfolio_etag(user_id):
+    """Return a tag that changes whenever the user's trades, cash or the prices of their holdings change."""
+    row = db.execute("SELECT version, (SELECT MAX(prices.Updated) FROM purchases JOIN prices ON prices.Symbol = purchases.Symbol "
+                     "WHERE user_id = ?) AS updated FROM users WHERE id = ?", user_id, user_id)[0]
+    return f"{user_id}-{row['version']}-{row['updated']}"
+
+
+def not_modified(etag):
+    """Return empty 304 response for a client whose copy is current."""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def api_error(message, code):
+    """Return message as JSON error."""
+    return jsonify({"error": message}), code
+
+
+@app.cli.command("rebuild-positions")
+def rebuild_positions():
+    """Regenerate every position, with its average cost and realized gain, by replaying history."""
+    print(f"rebuilt {orders.rebuild_positions(db)} positions")
 
-        # Redirect to home page to display portfolio
-        return redirect("/")
 
 def errorhandler(e):
     """Handle error"""
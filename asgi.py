@@ -0,0 +1,184 @@
+'''
+ASGI entry point, served alongside the WSGI application:app.
+
+GET /api/v1/quote/<symbol> is answered on the event loop with alookup, so
+one worker can hold hundreds of quote requests waiting on the provider,
+and GET /stream/portfolio streams price changes for the user's holdings
+as Server-Sent Events fed by a shared PriceHub. Every other request is
+passed through to the Flask app. Run with e.g.
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+'''
+
+import asyncio
+import json
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.wrappers import Request
+
+import ratelimit
+from application import QUOTE_LIMIT, app as flask_app, db, holdings, portfolio_totals
+from helpers import alookup
+from hub import SUBSCRIBER_QUEUE_SIZE, PriceHub
+
+QUOTE_PATH = "/api/v1/quote/"
+STREAM_PATH = "/stream/portfolio"
+
+# Seconds between checks for trades that changed the user's holdings, with a
+# keep-alive comment sent when there were none
+KEEPALIVE_INTERVAL = 15
+
+# Shared by every stream served by this worker
+hub = PriceHub(alookup)
+
+# Flask views run on a thread pool, as they would under a threaded WSGI server
+wsgi_app = WSGIMiddleware(flask_app)
+
+# Let pages open the portfolio stream this app serves
+flask_app.config["STREAMING"] = True
+
+
+async def app(scope, receive, send):
+    """Route quote lookups to the async handler and everything else to Flask."""
+    if scope["type"] == "http" and scope["method"] == "GET" and scope["path"].startswith(QUOTE_PATH):
+        await quote(scope, send)
+    elif scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == STREAM_PATH:
+        await stream_portfolio(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
+
+
+async def quote(scope, send):
+    """Get stock quote as JSON."""
+
+    # Require login and share the Flask view's rate limit, off the event loop since either may call Redis
+    user = await asyncio.to_thread(user_id, scope)
+    if not user:
+        return await respond(send, 401, {"error": "login required"})
+    if ratelimit.backend is not None:
+        wait = await asyncio.to_thread(ratelimit.backend.take, f"api_quote:{user}", *QUOTE_LIMIT)
+        if wait:
+            return await respond(send, 429, {"error": "too many requests"}, [(b"retry-after", str(max(1, round(wait))).encode())])
+
+    # If stock doesn't exist return error
+    stock = await alookup(scope["path"][len(QUOTE_PATH):])
+    if not stock:
+        return await respond(send, 404, {"error": "invalid symbol"})
+    return await respond(send, 200, stock)
+
+
+async def stream_portfolio(scope, receive, send):
+    """Stream changed prices and totals of the user's holdings as Server-Sent Events."""
+    user = await asyncio.to_thread(user_id, scope)
+    if not user:
+        return await respond(send, 401, {"error": "login required"})
+
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache, no-store, must-revalidate"),
+        (b"x-accel-buffering", b"no")
+    ]})
+    ticks = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    portfolio = await asyncio.to_thread(Portfolio.load, user)
+    for symbol in portfolio.positions:
+        hub.subscribe(symbol, ticks)
+    disconnected = asyncio.ensure_future(_disconnect(receive))
+    loop = asyncio.get_running_loop()
+    check = loop.time() + KEEPALIVE_INTERVAL
+    try:
+        while not disconnected.done():
+            tick = asyncio.ensure_future(ticks.get())
+            await asyncio.wait({tick, disconnected}, timeout=max(0, check - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+            if tick.done():
+                event = portfolio.update(tick.result())
+                if event:
+                    await _event(send, "price", event)
+            else:
+                tick.cancel()
+            if disconnected.done() or loop.time() < check:
+                continue
+            check = loop.time() + KEEPALIVE_INTERVAL
+
+            # Pick up trades made since the stream started, telling the page to reload its holdings
+            if await asyncio.to_thread(Portfolio.version_of, user) != portfolio.version:
+                latest = await asyncio.to_thread(Portfolio.load, user)
+                for symbol in portfolio.positions.keys() - latest.positions.keys():
+                    hub.unsubscribe(symbol, ticks)
+                for symbol in latest.positions.keys() - portfolio.positions.keys():
+                    hub.subscribe(symbol, ticks)
+                portfolio = latest
+                await _event(send, "reload", {})
+            else:
+                await send({"type": "http.response.body", "body": b": keep-alive\n\n", "more_body": True})
+    except OSError:
+        pass
+    finally:
+        disconnected.cancel()
+        for symbol in portfolio.positions:
+            hub.unsubscribe(symbol, ticks)
+
+
+class Portfolio:
+    """A user's positions and cash as of one version, revalued as ticks arrive."""
+
+    def __init__(self, version, cash, positions):
+        self.version = version
+        self.cash = cash
+        self.positions = positions
+
+    @staticmethod
+    def version_of(user):
+        return db.execute("SELECT version FROM users WHERE id = ?", user)[0]["version"]
+
+    @classmethod
+    def load(cls, user):
+        version = cls.version_of(user)
+        totals = portfolio_totals(user)
+        positions = {row["Symbol"]: {"shares": row["Shares"], "cost": float(row["Cost"]), "price": float(row["Price"])}
+                     for row in holdings(user)}
+        return cls(version, totals["cash"], positions)
+
+    def update(self, quote):
+        """Reprice a position from quote, returning the changes to show, or None if nothing changed."""
+        position = self.positions.get(quote["symbol"])
+        price = round(float(quote["price"]), 2)
+        if not position or position["price"] == price:
+            return None
+        position["price"] = price
+        value = sum(p["shares"] * p["price"] for p in self.positions.values())
+        cost = sum(p["cost"] for p in self.positions.values())
+        total = position["shares"] * price
+        return {"symbol": quote["symbol"], "price": price, "total": round(total, 2), "gain": round(total - position["cost"], 2),
+                "total_assets": round(self.cash + value, 2), "unrealized": round(value - cost, 2)}
+
+
+def user_id(scope):
+    """Return the id of the user the request's session belongs to, or None."""
+    headers = dict(scope["headers"])
+    request = Request({"REQUEST_METHOD": "GET", "HTTP_COOKIE": headers.get(b"cookie", b"").decode("latin-1")})
+    with flask_app.app_context():
+        session = flask_app.session_interface.open_session(flask_app, request)
+    return session.get("user_id") if session else None
+
+
+async def respond(send, status, data, headers=()):
+    """Send data as an uncached JSON response."""
+    body = json.dumps(data).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+        (b"cache-control", b"no-cache, no-store, must-revalidate"),
+        *headers
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _event(send, name, data):
+    """Send one Server-Sent Event."""
+    await send({"type": "http.response.body", "body": f"event: {name}\ndata: {json.dumps(data)}\n\n".encode(), "more_body": True})
+
+
+async def _disconnect(receive):
+    """Return once the client has gone away."""
+    while (await receive())["type"] != "http.disconnect":
+        pass
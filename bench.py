@@ -0,0 +1,170 @@
+'''
+Benchmark the trading routes offline.
+
+Copies finance.db to a temporary directory, seeds it with users, holdings
+and history, then drives /login, /buy, /sell, /update, / and /history of
+application:app from several worker processes, each logged in as its own
+user, with quotes from the synthetic provider. Reports latency
+percentiles, throughput and database queries per route. For example
+
+    python bench.py --concurrency 4 --requests 500 --holdings 50 --history 5000
+
+Pass --database-url to benchmark against another database instead; it is
+seeded the same way, so use a throwaway one.
+'''
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+from itertools import islice, product
+from string import ascii_uppercase
+
+ROUTES = ("login", "buy", "sell", "update", "index", "history")
+
+# Password of every benchmark user
+PASSWORD = "bench"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the trading routes of application:app.")
+    parser.add_argument("--concurrency", type=int, default=4, help="worker processes, each with its own user")
+    parser.add_argument("--requests", type=int, default=200, help="requests made by each worker")
+    parser.add_argument("--holdings", type=int, default=20, help="distinct symbols held by each user")
+    parser.add_argument("--history", type=int, default=1000, help="past trades seeded for each user")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma-separated routes to drive")
+    parser.add_argument("--database-url", help="database to seed and use instead of a copy of finance.db")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the choice of routes and symbols")
+    args = parser.parse_args()
+    routes = args.routes.split(",")
+    for route in routes:
+        if route not in ROUTES:
+            parser.error(f"unknown route: {route}")
+
+    # Configure the app before anything imports it, so the workers inherit the same settings
+    workdir = tempfile.mkdtemp(prefix="finance-bench-")
+    if not args.database_url:
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "finance.db"), workdir)
+        args.database_url = f"sqlite:///{os.path.join(workdir, 'finance.db')}"
+    os.environ.update(DATABASE_URL=args.database_url, QUOTE_PROVIDER="synthetic", RATE_LIMIT_BACKEND="off", REQUEST_LOG="off",
+                      SECRET_KEY=os.environ.get("SECRET_KEY", "bench"))
+    os.environ.pop("PRICE_REFRESHER", None)
+
+    try:
+        users = seed(args.concurrency, args.holdings, args.history)
+        print(f"seeded {len(users)} users with {args.holdings} holdings and {args.history} trades each")
+
+        # Spawn rather than fork so no worker shares a database connection with this process
+        context = multiprocessing.get_context("spawn")
+        jobs = [(user_id, symbols, routes, args.requests, args.seed + i) for i, (user_id, symbols) in enumerate(users)]
+        started = time.perf_counter()
+        with context.Pool(args.concurrency) as pool:
+            samples = [sample for result in pool.map(drive, jobs) for sample in result]
+        elapsed = time.perf_counter() - started
+        report(samples, elapsed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def seed(count, holdings, history):
+    """Create count users with holdings and history, returning (user id, held symbols) for each."""
+    from werkzeug.security import generate_password_hash
+
+    from application import db
+    from helpers import lookup_many, save_prices, transaction
+
+    symbols = ["".join(letters) for letters in islice(product(ascii_uppercase, repeat=3), holdings)]
+    quotes = lookup_many(symbols)
+    pass_hash = generate_password_hash(PASSWORD)
+    users = []
+    with transaction(db):
+        save_prices(db, quotes.values())
+        for _ in range(count):
+            user_id = db.execute("INSERT INTO users(username, hash, cash) VALUES(?, ?, ?) RETURNING id",
+                                 f"bench-{os.urandom(6).hex()}", pass_hash, 10 ** 9)[0]["id"]
+            for symbol in symbols:
+                db.execute("INSERT INTO purchases (user_id, Symbol, Shares, Cost) VALUES (?, ?, ?, ?)",
+                           user_id, symbol, 1000, 1000 * quotes[symbol]["price"])
+            for i in range(history):
+                symbol = symbols[i % len(symbols)]
+                db.execute("INSERT INTO history(Date, user_id, Symbol, Shares, Price, [Transaction]) VALUES (?, ?, ?, ?, ?, ?)",
+                           time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - history + i)),
+                           user_id, symbol, 1, quotes[symbol]["price"], "Purchase")
+            users.append((user_id, symbols))
+    return users
+
+
+def drive(job):
+    """Make requests as one user, returning (route, seconds, queries, status) for each."""
+    user_id, symbols, routes, count, seed = job
+    import application
+
+    # Count every statement the app runs on its handle
+    queries = [0]
+    execute = application.db.execute
+
+    def counted(*args, **kwargs):
+        queries[0] += 1
+        return execute(*args, **kwargs)
+    application.db.execute = counted
+
+    username = application.db.execute("SELECT username FROM users WHERE id = ?", user_id)[0]["username"]
+    client = application.app.test_client()
+    client.post("/login", data={"username": username, "password": PASSWORD})
+
+    rand = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        route = rand.choice(routes)
+        symbol = rand.choice(symbols)
+        queries[0] = 0
+        started = time.perf_counter()
+        if route == "login":
+            response = client.post("/login", data={"username": username, "password": PASSWORD})
+        elif route == "buy":
+            response = client.post("/buy", data={"symbol": symbol, "shares": "1"})
+        elif route == "sell":
+            response = client.post("/sell", data={"symbol": symbol, "shares": "1"})
+        elif route == "update":
+            response = client.post("/update")
+        elif route == "index":
+            response = client.get("/")
+        else:
+            response = client.get("/history")
+        response.get_data()
+        samples.append((route, time.perf_counter() - started, queries[0], response.status_code))
+    return samples
+
+
+def report(samples, elapsed):
+    """Print latency percentiles, throughput and queries per route."""
+    by_route = defaultdict(list)
+    for sample in samples:
+        by_route[sample[0]].append(sample)
+
+    print(f"{len(samples)} requests in {elapsed:.2f}s, {len(samples) / elapsed:.1f} req/s")
+    print(f"{'route':<8} {'count':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for route in ROUTES:
+        if route not in by_route:
+            continue
+        rows = by_route[route]
+        latencies = sorted(seconds * 1000 for _, seconds, _, _ in rows)
+        errors = sum(1 for _, _, _, status in rows if status >= 400)
+        queries = sum(count for _, _, count, _ in rows) / len(rows)
+        print(f"{route:<8} {len(rows):>6} {errors:>6} {len(rows) / elapsed:>8.1f} "
+              f"{percentile(latencies, 50):>8.1f} {percentile(latencies, 95):>8.1f} {percentile(latencies, 99):>8.1f} {queries:>8.1f}")
+
+
+def percentile(values, p):
+    """Return the pth percentile of sorted values by nearest rank."""
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+'''
+Pooled database access with the semantics of cs50.SQL.
+
+Database.execute takes one statement with ? or :name placeholders and returns a list
+of Row objects for queries (and for INSERT ... RETURNING, the way to get a new
+row's id on both SQLite and Postgres), the new row's id for other INSERTs on
+SQLite and the number of rows matched for UPDATE and DELETE. Statements run on
+connections from a SQLAlchemy pool. On SQLite they are passed to sqlite3 as
+written, so its per-connection statement cache saves re-parsing them; for
+psycopg2, which has no such cache, the placeholder conversion is memoized.
+
+Outside a transaction every statement commits on its own. BEGIN pins a
+connection to the calling thread until COMMIT or ROLLBACK, so each thread
+can run its own transaction on the same Database.
+'''
+
+import decimal
+import functools
+import os
+import re
+import sqlite3
+import threading
+
+import sqlalchemy
+
+# Pragmas set on every SQLite connection: write-ahead logging lets readers
+# proceed while a write commits, and writers wait for each other rather than fail
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+class Row(dict):
+    """Result row, indexable by column name or readable as attributes."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Database:
+    """Pool of connections to the database at url."""
+
+    def __init__(self, url, pool_size=5, max_overflow=10):
+
+        # Require that file already exist for SQLite, as cs50.SQL does
+        matches = re.search(r"^sqlite:///(.+)$", url)
+        if matches and not os.path.isfile(matches.group(1)):
+            raise RuntimeError(f"does not exist: {matches.group(1)}")
+
+        self.dialect = "sqlite" if matches else sqlalchemy.engine.make_url(url).get_backend_name()
+        options = {"connect_args": {"cached_statements": 256, "check_same_thread": False}} if self.dialect == "sqlite" else {}
+        self._engine = sqlalchemy.create_engine(url, pool_size=pool_size, max_overflow=max_overflow,
+                                                pool_pre_ping=self.dialect != "sqlite", **options
+                                                ).execution_options(isolation_level="AUTOCOMMIT")
+        sqlalchemy.event.listen(self._engine, "connect", self._connect)
+        self._local = threading.local()
+
+        # Test database
+        try:
+            self.execute("SELECT 1")
+        except sqlalchemy.exc.OperationalError as e:
+            raise RuntimeError(e.orig) from None
+
+    def _connect(self, dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            cursor = dbapi_connection.cursor()
+            for pragma in SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+            cursor.close()
+
+    def execute(self, sql, *args, **kwargs):
+        """Execute a SQL statement."""
+        if args and kwargs:
+            raise RuntimeError("cannot pass both positional and named parameters")
+        args = kwargs or tuple(args)
+        command, statement = _prepare(sql, self.dialect, "named" if kwargs else "qmark" if args else None)
+        connection = getattr(self._local, "connection", None)
+
+        # Keep the connection a transaction started on until it ends
+        if command == "BEGIN":
+            if connection is not None:
+                raise RuntimeError("transaction already in progress")
+            connection = self._local.connection = self._engine.connect()
+            return self._run(connection, command, statement, args, release=False)
+        if command in ("COMMIT", "ROLLBACK", "END") and connection is not None:
+            del self._local.connection
+            return self._run(connection, command, statement, args, release=True)
+
+        # Otherwise commit the statement by itself on any pooled connection
+        if connection is None:
+            return self._run(self._engine.connect(), command, statement, args, release=True)
+        return self._run(connection, command, statement, args, release=False)
+
+    def _run(self, connection, command, statement, args, release):
+        try:
+            result = connection.exec_driver_sql(statement, args)
+            if result.returns_rows:
+                return [Row((key, _coerce(value)) for key, value in row.items()) for row in result.mappings()]
+            if command == "INSERT":
+                if self.dialect == "postgresql":
+                    return None
+                return result.lastrowid if result.rowcount == 1 else None
+            if command in ("UPDATE", "DELETE"):
+                return result.rowcount
+            return True
+
+        # Raise what cs50.SQL raises, which callers already handle
+        except sqlalchemy.exc.IntegrityError as e:
+            raise ValueError(e.orig) from None
+        except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError) as e:
+            if not release:
+                # A broken transaction can't continue, so give the connection back
+                self._local.__dict__.pop("connection", None)
+                connection.close()
+            raise RuntimeError(e.orig) from None
+        finally:
+            if release:
+                connection.close()
+
+
+@functools.lru_cache(maxsize=1024)
+def _prepare(sql, dialect, paramstyle):
+    """Return the command of sql and sql in the driver's parameter style."""
+    statement = sql.strip()
+    command = statement.split(None, 1)[0].upper() if statement else ""
+    if command == "START":
+        command = "BEGIN"
+    if dialect == "sqlite":
+        if command == "BEGIN":
+            # Take the write lock up front so concurrent transactions queue rather than deadlock
+            statement = "BEGIN IMMEDIATE"
+        return command, statement
+    return command, _pyformat(statement, paramstyle) if paramstyle else statement
+
+
+def _pyformat(sql, paramstyle):
+    """Convert ? or :name placeholders outside quotes to psycopg2's, escaping literal percent signs."""
+    parts = re.split(r"('(?:[^']|'')*'|\"[^\"]*\")", sql)
+    for i, part in enumerate(parts):
+        part = part.replace("%", "%%")
+        if i % 2 == 0:
+            if paramstyle == "qmark":
+                part = part.replace("?", "%s")
+            else:
+                part = re.sub(r"(?<![:\w]):(\w+)", r"%(\1)s", part)
+        parts[i] = part
+    return "".join(parts)
+
+
+def _coerce(value):
+    """Convert driver types to the plain Python types cs50.SQL returned."""
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, memoryview):
+        return bytes(value)
+    return value
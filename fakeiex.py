@@ -0,0 +1,124 @@
+'''
+Fake IEX quote server, for running the app and checking the quote clients
+without an API key or network access.
+
+Serves /stock/<symbol>/quote and /stock/market/batch for the symbols in
+PRICES, 404 for any other symbol, and 503 for everything while failing is
+set. Serve it with
+
+    python fakeiex.py --serve 8901
+
+and start the app with IEX_BASE_URL=http://127.0.0.1:8901 API_KEY=fake, or
+run it with no arguments to check alookup against it: a known symbol, an
+unknown one, and a stale quote once the server fails and the circuit
+breaker opens.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latest price of every symbol the server knows
+PRICES = {"AAPL": 150.25, "MSFT": 310.5, "NFLX": 480.0}
+
+
+class FakeIEXHandler(BaseHTTPRequestHandler):
+    """Answer IEX quote and batch requests from PRICES."""
+
+    # Requests handled, and whether to fail them all, shared by every handler
+    requests = 0
+    failing = False
+
+    def do_GET(self):
+        FakeIEXHandler.requests += 1
+        url = urllib.parse.urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if FakeIEXHandler.failing:
+            return self.reply(503, {"error": "unavailable"})
+        if parts == ["stock", "market", "batch"]:
+            symbols = urllib.parse.parse_qs(url.query).get("symbols", [""])[0].split(",")
+            return self.reply(200, {symbol: {"quote": quote(symbol)} for symbol in symbols if symbol.upper() in PRICES})
+        if len(parts) == 3 and parts[0] == "stock" and parts[2] == "quote" and parts[1].upper() in PRICES:
+            return self.reply(200, quote(parts[1]))
+        return self.reply(404, "Unknown symbol")
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def quote(symbol):
+    """Return the IEX quote object for a known symbol."""
+    symbol = symbol.upper()
+    return {"symbol": symbol, "companyName": f"{symbol} Inc.", "latestPrice": PRICES[symbol]}
+
+
+def serve(port=0):
+    """Start the server on a daemon thread, returning it; port 0 picks a free port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeIEXHandler)
+    threading.Thread(target=server.serve_forever, name="fake-iex", daemon=True).start()
+    return server
+
+
+def check():
+    """Check alookup against a fake server, returning whether every case passed."""
+    server = serve()
+
+    # Configure the provider before helpers builds it, with a breaker that opens on the first failure
+    os.environ.update(QUOTE_PROVIDER="iex", IEX_BASE_URL=f"http://127.0.0.1:{server.server_port}", API_KEY="fake",
+                      QUOTE_RETRIES="0", QUOTE_BREAKER_THRESHOLD="1", QUOTE_BREAKER_RESET="60")
+    import helpers
+
+    async def run():
+        results = []
+        stock = await helpers.alookup("aapl")
+        results.append(("known symbol", stock == {"symbol": "AAPL", "name": "AAPL Inc.", "price": 150.25}))
+        results.append(("unknown symbol", await helpers.alookup("nope") is None))
+
+        # Cache the quote already expired, then fail the server: the first lookup trips the breaker, the second fails fast
+        helpers.quote_cache.ttl = 0
+        helpers.quote_cache.put("AAPL", stock)
+        FakeIEXHandler.failing = True
+        first = await helpers.alookup("AAPL")
+        before = FakeIEXHandler.requests
+        second = await helpers.alookup("AAPL")
+        results.append(("stale on failure", first == dict(stock, stale=True)))
+        results.append(("stale with breaker open", second == dict(stock, stale=True) and FakeIEXHandler.requests == before))
+        return results
+
+    results = asyncio.run(run())
+    server.shutdown()
+    for name, passed in results:
+        print(f"{'ok' if passed else 'FAIL'}  {name}")
+    return all(passed for _, passed in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake IEX quote server.")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="serve on PORT until interrupted instead of checking alookup")
+    args = parser.parse_args()
+    if args.serve is None:
+        return 0 if check() else 1
+    server = serve(args.serve)
+    print(f"serving fake IEX quotes on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,19 @@
+import asyncio
 import os
-import requests
-import urllib.parse
+import threading
+import time
 
-from flask import redirect, render_template, request, session
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import g, jsonify, make_response, redirect, render_template, request, session
 from functools import wraps
+from time import gmtime, strftime
+
+import pricehistory
+import ratelimit
+from instrumentation import InstrumentedProvider
+from providers import PROVIDER_ERRORS, create_provider
 
 
 def apology(message, code=400):
@@ -30,36 +40,360 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
+            # API clients get an error they can act on rather than the login page
+            if request.path.startswith("/api/"):
+                return jsonify({"error": "login required"}), 401
             return redirect("/login")
+
+        # Resolve identity per request, so concurrent requests never see each other's user
+        g.user_id = session["user_id"]
         return f(*args, **kwargs)
     return decorated_function
 
 
+def rate_limit(rate, burst, methods=None):
+    """
+    Decorate routes to allow each user (or, before login, each client address)
+    rate requests a second, in bursts of up to burst, counting only requests
+    with one of methods if given.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if ratelimit.backend is not None and (methods is None or request.method in methods):
+                who = g.get("user_id") or request.remote_addr
+                wait = ratelimit.backend.take(f"{request.endpoint}:{who}", rate, burst)
+                if wait:
+                    return too_many_requests(wait)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def too_many_requests(wait):
+    """Return 429 response telling the client how many seconds to wait."""
+    if request.path.startswith("/api/"):
+        response = make_response(jsonify({"error": "too many requests"}), 429)
+    else:
+        response = make_response(apology("too many requests", 429))
+    response.headers["Retry-After"] = str(max(1, round(wait)))
+    return response
+
+
+@contextmanager
+def transaction(db):
+    """Run the enclosed db.execute calls as a single transaction, rolling back on error."""
+    db.execute("BEGIN")
+    try:
+        yield
+    except BaseException:
+        try:
+            db.execute("ROLLBACK")
+        except RuntimeError:
+            # A failed statement already dropped the connection, and the transaction with it
+            pass
+        raise
+    db.execute("COMMIT")
+
+
+# Most prices written by a single upsert, keeping well under SQLite's bound parameter limit
+PRICE_BATCH_SIZE = 200
+
+
+def save_prices(db, quotes):
+    """Store each quote as the latest price of its symbol, shared by every holder."""
+    rows = [(quote["symbol"], quote["name"], round(float(quote["price"]), 2))
+            for quote in quotes if quote and not quote.get("stale")]
+    updated = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+    for i in range(0, len(rows), PRICE_BATCH_SIZE):
+        batch = rows[i:i + PRICE_BATCH_SIZE]
+        db.execute("INSERT INTO prices(Symbol, Name, Price, Updated) VALUES " + ", ".join(["(?, ?, ?, ?)"] * len(batch)) +
+                   " ON CONFLICT(Symbol) DO UPDATE SET Name = excluded.Name, Price = excluded.Price, Updated = excluded.Updated",
+                   *[value for row in batch for value in (*row, updated)])
+
+
+class QuoteCache:
+    """
+    Process-wide LRU cache of quotes keyed by normalized symbol.
+
+    Quotes are served for `ttl` seconds, unknown symbols are remembered for
+    `negative_ttl` seconds, and concurrent misses for the same symbol wait
+    on a single in-flight fetch instead of each going upstream.
+    """
+
+    def __init__(self, ttl=15, negative_ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, symbol, fetch):
+        """Return quote for symbol, calling fetch(symbol) on a miss."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(symbol)
+                self.hits += 1
+                return entry[1]
+
+            # Join a fetch already in progress for this symbol
+            flight = self._inflight.get(symbol)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[symbol] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = fetch(symbol)
+        except Exception as e:
+            flight.error = e
+        else:
+            self.put(symbol, flight.result)
+        finally:
+            with self._lock:
+                del self._inflight[symbol]
+            flight.done.set()
+        return flight.wait()
+
+    def get_many(self, symbols, fetch, batch_size, errors=()):
+        """
+        Return a dict of symbol to quote for symbols, calling fetch(batch) on batches of
+        up to batch_size of the symbols missed that no other caller is fetching already,
+        and waiting on the fetches of the rest. Symbols whose fetch raised one of errors
+        are left out.
+        """
+        quotes = {}
+        led = {}
+        joined = {}
+        with self._lock:
+            now = time.monotonic()
+            for symbol in symbols:
+                entry = self._entries.get(symbol)
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(symbol)
+                    self.hits += 1
+                    quotes[symbol] = entry[1]
+                elif symbol in self._inflight:
+                    joined[symbol] = self._inflight[symbol]
+                    self.coalesced += 1
+                else:
+                    led[symbol] = self._inflight[symbol] = _Flight()
+                    self.misses += 1
+
+        # Fetch the symbols this call leads, releasing each batch's waiters as soon as it's done
+        batches = list(led)
+        for i in range(0, len(batches), batch_size):
+            batch = batches[i:i + batch_size]
+            try:
+                fetched = fetch(batch)
+            except Exception as e:
+                for symbol in batch:
+                    led[symbol].error = e
+            else:
+                for symbol in batch:
+                    led[symbol].result = fetched.get(symbol)
+                    self.put(symbol, led[symbol].result)
+            finally:
+                with self._lock:
+                    for symbol in batch:
+                        del self._inflight[symbol]
+                for symbol in batch:
+                    led[symbol].done.set()
+
+        for symbol, flight in (*led.items(), *joined.items()):
+            try:
+                quotes[symbol] = flight.wait()
+            except errors:
+                pass
+        return quotes
+
+    def peek(self, symbol):
+        """Return (True, quote) if symbol has a fresh entry, else (False, None)."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(symbol)
+                self.hits += 1
+                return True, entry[1]
+            return False, None
+
+    def put(self, symbol, quote):
+        """Store quote (or None for an unknown symbol), evicting the least recently used entry."""
+        ttl = self.ttl if quote else self.negative_ttl
+        with self._lock:
+            self._entries[symbol] = (time.monotonic() + ttl, quote)
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def count(self, counter):
+        """Increment one of the hits/misses/coalesced counters."""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stale(self, symbol):
+        """Return the last quote stored for symbol however old, or None."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            return entry[1] if entry else None
+
+    def clear(self):
+        """Forget all cached quotes."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss/coalesced counters for sizing the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "maxsize": self.maxsize
+            }
+
+
+class _Flight:
+    """Upstream fetch shared by every caller that missed on the same symbol."""
+
+    def __init__(self):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+# Shared by every request handled by this process
+provider = InstrumentedProvider(create_provider(os.environ.get("QUOTE_PROVIDER", "iex")))
+quote_cache = QuoteCache(ttl=float(os.environ.get("QUOTE_CACHE_TTL", 15)),
+                         negative_ttl=float(os.environ.get("QUOTE_CACHE_NEGATIVE_TTL", 60)),
+                         maxsize=int(os.environ.get("QUOTE_CACHE_SIZE", 1024)))
+
+
+# Most single-symbol requests lookup_many runs at once when batching fails
+LOOKUP_CONCURRENCY = int(os.environ.get("LOOKUP_CONCURRENCY", 8))
+
+
+def normalize_symbol(symbol):
+    """Return symbol stripped and upper-cased, or None if blank or not a string (as from JSON)."""
+    if not isinstance(symbol, str):
+        return None
+    return symbol.strip().upper() or None
+
+
 def lookup(symbol):
     """Look up quote for symbol."""
+    symbol = normalize_symbol(symbol)
+    if not symbol:
+        return None
 
-    # Contact API
+    # Serve from cache, sharing a single upstream fetch between concurrent misses
     try:
-        api_key = os.environ.get("API_KEY")
-        url = f"https://cloud.iexapis.com/stable/stock/{urllib.parse.quote_plus(symbol)}/quote?token={api_key}"
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException:
+        quote = quote_cache.get(symbol, _fetch_quote)
+    except PROVIDER_ERRORS:
+        return _stale(symbol)
+    return dict(quote) if quote else None
+
+
+async def alookup(symbol):
+    """Look up quote for symbol without blocking the event loop."""
+    symbol = normalize_symbol(symbol)
+    if not symbol:
         return None
 
-    # Parse response
+    hit, quote = quote_cache.peek(symbol)
+    if hit:
+        return dict(quote) if quote else None
+
+    # Share a single upstream fetch between concurrent misses on this event loop
+    task = _async_inflight.get(symbol)
+    if task:
+        quote_cache.count("coalesced")
+    else:
+        quote_cache.count("misses")
+        task = _async_inflight[symbol] = asyncio.ensure_future(_afetch_quote(symbol))
+        task.add_done_callback(lambda _: _async_inflight.pop(symbol, None))
     try:
-        quote = response.json()
-        return {
-            "name": quote["companyName"],
-            "price": float(quote["latestPrice"]),
-            "symbol": quote["symbol"]
-        }
-    except (KeyError, TypeError, ValueError):
-        return None
+        quote = await asyncio.shield(task)
+    except PROVIDER_ERRORS:
+        return _stale(symbol)
+    return dict(quote) if quote else None
+
+
+# Fetches in flight on the event loop, by symbol
+_async_inflight = {}
+
+
+def lookup_many(symbols):
+    """Look up quotes for several symbols, returning a dict of symbol to quote (or None)."""
+    wanted = list(dict.fromkeys(filter(None, map(normalize_symbol, symbols))))
+
+    # Serve what we can from cache, and fetch the rest in as few upstream requests as the batch
+    # endpoint allows, sharing fetches other callers already have in flight
+    quotes = {symbol: dict(quote) if quote else None
+              for symbol, quote in quote_cache.get_many(wanted, _fetch_quotes, provider.batch_size, PROVIDER_ERRORS).items()}
+    if len(quotes) == len(wanted):
+        return quotes
+
+    # Serve last known prices without queueing doomed requests if the provider is down
+    missing = [symbol for symbol in wanted if symbol not in quotes]
+    if provider.degraded():
+        quotes.update((symbol, _stale(symbol)) for symbol in missing)
+        return quotes
+
+    # Fall back to bounded concurrent single-symbol lookups
+    with ThreadPoolExecutor(max_workers=min(LOOKUP_CONCURRENCY, len(missing))) as executor:
+        quotes.update(zip(missing, executor.map(lookup, missing)))
+    return quotes
+
+
+def _stale(symbol):
+    """Return the last cached quote for symbol marked as stale, or None."""
+    quote = quote_cache.stale(symbol)
+    return dict(quote, stale=True) if quote else None
+
+
+def _fetch_quote(symbol):
+    """Fetch quote from the provider and record it in the price history."""
+    quote = provider.quote(symbol)
+    pricehistory.recorder.record([quote])
+    return quote
+
+
+def _fetch_quotes(symbols):
+    """Fetch quotes for symbols from the provider in one request and record them in the price history."""
+    fetched = provider.quotes(symbols)
+    pricehistory.recorder.record(fetched.values())
+    return fetched
+
 
+async def _afetch_quote(symbol):
+    """Fetch quote from the provider asynchronously, record it in the price history and cache it."""
+    quote = await provider.aquote(symbol)
+    pricehistory.recorder.record([quote])
+    quote_cache.put(symbol, quote)
+    return quote
 
 
 def usd(value):
     """Format value as USD."""
-    return f"${value:,.2f}"
+    return f"${float(value):,.2f}"
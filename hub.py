@@ -0,0 +1,83 @@
+'''
+Fan-out of price ticks to streaming clients on the event loop.
+
+The first subscriber to a symbol starts one task that polls its quote and
+publishes it whenever the price changes; later subscribers share it, and
+it stops when the last one leaves. Quotes come through alookup, so the
+quote cache and coalescing still sit in front of the provider.
+'''
+
+import asyncio
+import logging
+import os
+
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Seconds between polls of each watched symbol
+STREAM_INTERVAL = float(os.environ.get("STREAM_INTERVAL", 5))
+
+# Ticks buffered per subscriber before the oldest are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+class PriceHub:
+    """Per-symbol publishers with many subscriber queues each."""
+
+    def __init__(self, fetch, interval=STREAM_INTERVAL):
+        self.fetch = fetch
+        self.interval = interval
+        self._subscribers = defaultdict(set)
+        self._watchers = {}
+        self._last = {}
+
+    def subscribe(self, symbol, queue):
+        """Deliver ticks for symbol to queue, starting with the last one if there is one."""
+        self._subscribers[symbol].add(queue)
+        if symbol not in self._watchers:
+            self._watchers[symbol] = asyncio.ensure_future(self._watch(symbol))
+        elif symbol in self._last:
+            _offer(queue, self._last[symbol])
+
+    def unsubscribe(self, symbol, queue):
+        """Stop delivering ticks for symbol to queue, and stop watching symbol if nobody else is."""
+        subscribers = self._subscribers.get(symbol)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[symbol]
+            self._watchers.pop(symbol).cancel()
+            self._last.pop(symbol, None)
+
+    def publish(self, quote):
+        """Deliver quote to its symbol's subscribers if its price has changed."""
+        last = self._last.get(quote["symbol"])
+        if last and last["price"] == quote["price"]:
+            return
+        self._last[quote["symbol"]] = quote
+        for queue in self._subscribers.get(quote["symbol"], ()):
+            _offer(queue, quote)
+
+    def watching(self):
+        """Return how many symbols are being watched."""
+        return len(self._watchers)
+
+    async def _watch(self, symbol):
+        while True:
+            # Keep polling after an unexpected error, since subscribers rely on this task to be running
+            try:
+                quote = await self.fetch(symbol)
+                if quote and not quote.get("stale"):
+                    self.publish(quote)
+            except Exception:
+                logger.exception("watching %s failed", symbol)
+            await asyncio.sleep(self.interval)
+
+
+def _offer(queue, quote):
+    """Put quote on queue, dropping its oldest tick if a slow client has let it fill up."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(quote)
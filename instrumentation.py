@@ -0,0 +1,219 @@
+'''
+Lightweight request instrumentation.
+
+InstrumentedSQL and InstrumentedProvider wrap the database handle and the
+quote provider, timing every statement and upstream call. init_app adds
+the time spent in each to the current request's Server-Timing header and
+to one JSON log line per request (logger "instrumentation", level INFO,
+written to stderr unless REQUEST_LOG=off), and everything is added up in counters rendered in Prometheus text format
+by render. Counters are kept per process.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Type and help text of each metric
+METRICS = {
+    "http_requests_total": ("counter", "Requests handled, by route, method and status."),
+    "http_request_duration_seconds": ("histogram", "Time taken to handle requests, by route."),
+    "db_queries_total": ("counter", "SQL statements executed."),
+    "db_query_duration_seconds_total": ("counter", "Time spent executing SQL statements."),
+    "upstream_requests_total": ("counter", "Calls to the quote provider, by method and outcome."),
+    "upstream_duration_seconds_total": ("counter", "Time spent waiting for the quote provider, by method."),
+}
+
+
+class Registry:
+    """Thread-safe counters and histograms, keyed by metric name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets, total = self._histograms.get(key, ([0] * len(DURATION_BUCKETS), 0))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            self._histograms[key] = (buckets, total + value)
+            self._counters[(name + "_count", key[1])] += 1
+
+    def render(self):
+        """Return every metric in Prometheus text format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(buckets), total) for key, (buckets, total) in self._histograms.items()}
+
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), (buckets, total) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(DURATION_BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {count}")
+                    count = counters[(name + "_count", labels)]
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count:g}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_labels(labels)} {count:g}")
+            else:
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every request handled by this process
+registry = Registry()
+
+
+class InstrumentedSQL:
+    """Wrap a database handle, timing every statement it executes."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, sql, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self.db.execute(sql, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            _record("db", seconds)
+            registry.inc("db_queries_total")
+            registry.inc("db_query_duration_seconds_total", seconds)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class InstrumentedProvider:
+    """Wrap a quote provider, timing every call that reaches it."""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def quote(self, symbol):
+        return self._timed("quote", self.provider.quote, symbol)
+
+    def quotes(self, symbols):
+        return self._timed("quotes", self.provider.quotes, symbols)
+
+    async def aquote(self, symbol):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            quote = await self.provider.aquote(symbol)
+            outcome = "ok"
+            return quote
+        finally:
+            self._observe("aquote", outcome, time.perf_counter() - started)
+
+    def _timed(self, method, call, *args):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = call(*args)
+            outcome = "ok"
+            return result
+        finally:
+            self._observe(method, outcome, time.perf_counter() - started)
+
+    def _observe(self, method, outcome, seconds):
+        _record("quote", seconds)
+        registry.inc("upstream_requests_total", method=method, outcome=outcome)
+        registry.inc("upstream_duration_seconds_total", seconds, method=method)
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+
+def init_app(app):
+    """Time every request app handles, reporting it in Server-Timing headers, logs and counters."""
+
+    # Write request logs to stderr ourselves, since gunicorn and uvicorn don't configure logging for the app
+    if os.environ.get("REQUEST_LOG", "on") != "off" and not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    @app.before_request
+    def start_timer():
+        g.timings = {"db": [0, 0.0], "quote": [0, 0.0]}
+        g.started = time.perf_counter()
+
+    @app.after_request
+    def report_timings(response):
+        if "started" not in g:
+            return response
+        elapsed = time.perf_counter() - g.started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        (queries, db_seconds), (calls, quote_seconds) = g.timings["db"], g.timings["quote"]
+
+        response.headers["Server-Timing"] = ", ".join([
+            f'db;dur={db_seconds * 1000:.1f};desc="{queries} queries"',
+            f'quote;dur={quote_seconds * 1000:.1f};desc="{calls} calls"',
+            f"total;dur={elapsed * 1000:.1f}"
+        ])
+        logger.info(json.dumps({
+            "method": request.method,
+            "route": route,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 2),
+            "db_queries": queries,
+            "db_ms": round(db_seconds * 1000, 2),
+            "quote_calls": calls,
+            "quote_ms": round(quote_seconds * 1000, 2),
+            "user_id": g.get("user_id")
+        }))
+        registry.inc("http_requests_total", route=route, method=request.method, status=response.status_code)
+        registry.observe("http_request_duration_seconds", elapsed, route=route)
+        return response
+
+
+def render(cache_stats):
+    """Return all counters, and the quote cache's, in Prometheus text format."""
+    lines = [registry.render()]
+    for name in ("hits", "misses", "coalesced", "evictions"):
+        lines.append(f"# TYPE quote_cache_{name}_total counter\nquote_cache_{name}_total {cache_stats[name]}\n")
+    for name in ("size", "maxsize"):
+        lines.append(f"# TYPE quote_cache_{name} gauge\nquote_cache_{name} {cache_stats[name]}\n")
+    return "".join(lines)
+
+
+def _record(kind, seconds):
+    """Add a timed call to the current request's totals, if there is one."""
+    if has_request_context() and "timings" in g:
+        totals = g.timings[kind]
+        totals[0] += 1
+        totals[1] += seconds
+
+
+def _labels(labels):
+    """Format label pairs as a Prometheus label set."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
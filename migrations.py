@@ -0,0 +1,165 @@
+from time import gmtime, strftime
+
+from helpers import transaction
+
+
+def migrate(db, dialect):
+    """Apply every migration newer than the database's schema version, in order."""
+    db.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version integer PRIMARY KEY, applied timestamp)")
+    applied = {row["version"] for row in db.execute("SELECT version FROM schema_migrations")}
+
+    for version, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with transaction(db):
+                migration(db, dialect)
+                db.execute("INSERT INTO schema_migrations (version, applied) VALUES (?, ?)",
+                           version, strftime("%Y-%m-%d %H:%M:%S", gmtime()))
+        except (RuntimeError, ValueError):
+            # Another worker starting alongside this one may have applied it first
+            if not db.execute("SELECT version FROM schema_migrations WHERE version = ?", version):
+                raise
+
+
+def _columns(db, dialect, table):
+    """Return lower-cased names of table's columns."""
+    if dialect == "postgresql":
+        rows = db.execute("SELECT column_name AS name FROM information_schema.columns WHERE table_name = ?", table)
+    else:
+        rows = db.execute("SELECT name FROM pragma_table_info(?)", table)
+    return {row["name"].lower() for row in rows}
+
+
+def _prices_table(db, dialect):
+    """Move company name and latest price out of purchases into one shared row per symbol."""
+    if "cost" in _columns(db, dialect, "purchases"):
+        return
+    db.execute("CREATE TABLE IF NOT EXISTS prices (Symbol text PRIMARY KEY NOT NULL, Name text, Price numeric NOT NULL, Updated timestamp)")
+    db.execute("INSERT INTO prices (Symbol, Name, Price) SELECT Symbol, MAX(Name), MAX(Price) FROM purchases GROUP BY Symbol")
+    db.execute("ALTER TABLE purchases ADD COLUMN Cost numeric")
+    db.execute("UPDATE purchases SET Cost = Total")
+    for column in ("Name", "Price", "Total"):
+        db.execute(f"ALTER TABLE purchases DROP COLUMN {column}")
+
+
+def _history_surrogate_key(db, dialect):
+    """Key history by an integer id so two trades in the same second don't collide."""
+    if dialect == "postgresql":
+        db.execute("ALTER TABLE history DROP CONSTRAINT IF EXISTS history_pkey")
+        db.execute("ALTER TABLE history ADD COLUMN id SERIAL PRIMARY KEY")
+        return
+
+    # SQLite can't change a table's primary key, so rebuild it
+    db.execute("CREATE TABLE history_new (id integer PRIMARY KEY AUTOINCREMENT NOT NULL, Date datetime NOT NULL, "
+               "User text, Symbol text, Shares integer, Price text, [Transaction] text)")
+    db.execute("INSERT INTO history_new (Date, User, Symbol, Shares, Price, [Transaction]) "
+               "SELECT Date, User, Symbol, Shares, Price, [Transaction] FROM history ORDER BY Date")
+    db.execute("DROP TABLE history")
+    db.execute("ALTER TABLE history_new RENAME TO history")
+
+
+def _lookup_indexes(db, dialect):
+    """Index the columns every portfolio and history query filters on."""
+
+    # Merge any duplicate holdings so the unique index can be built
+    db.execute("UPDATE purchases SET "
+               "Shares = (SELECT SUM(Shares) FROM purchases p WHERE p.user_name = purchases.user_name AND p.Symbol = purchases.Symbol), "
+               "Cost = (SELECT SUM(Cost) FROM purchases p WHERE p.user_name = purchases.user_name AND p.Symbol = purchases.Symbol) "
+               "WHERE purchase_id IN (SELECT MIN(purchase_id) FROM purchases GROUP BY user_name, Symbol HAVING COUNT(*) > 1)")
+    db.execute("DELETE FROM purchases WHERE purchase_id NOT IN (SELECT MIN(purchase_id) FROM purchases GROUP BY user_name, Symbol)")
+
+    db.execute("CREATE UNIQUE INDEX purchases_user_symbol ON purchases (user_name, Symbol)")
+    user = '"user"' if dialect == "postgresql" else "User"
+    db.execute(f"CREATE INDEX history_user_date ON history ({user}, Date)")
+
+
+def _user_id_keys(db, dialect):
+    """Key holdings and history by integer user id instead of username."""
+    user = '"user"' if dialect == "postgresql" else "User"
+
+    db.execute("ALTER TABLE purchases ADD COLUMN user_id integer REFERENCES users (id)")
+    db.execute("UPDATE purchases SET user_id = (SELECT id FROM users WHERE users.username = purchases.user_name)")
+    db.execute("DROP INDEX purchases_user_symbol")
+    db.execute("ALTER TABLE purchases DROP COLUMN user_name")
+    db.execute("CREATE UNIQUE INDEX purchases_user_symbol ON purchases (user_id, Symbol)")
+
+    db.execute("ALTER TABLE history ADD COLUMN user_id integer REFERENCES users (id)")
+    db.execute(f"UPDATE history SET user_id = (SELECT id FROM users WHERE users.username = history.{user})")
+    db.execute("DROP INDEX history_user_date")
+    db.execute(f"ALTER TABLE history DROP COLUMN {user}")
+    db.execute("CREATE INDEX history_user_date ON history (user_id, Date)")
+
+
+def _portfolio_version(db, dialect):
+    """Count changes to each user's cash and holdings, for cheap conditional requests."""
+    db.execute("ALTER TABLE users ADD COLUMN version integer NOT NULL DEFAULT 0")
+
+
+def _realized_gains(db, dialect):
+    """Keep each position's realized gain alongside its shares and average cost basis."""
+    db.execute("ALTER TABLE purchases ADD COLUMN Realized numeric NOT NULL DEFAULT 0")
+
+
+def _open_orders(db, dialect):
+    """Store resting limit and stop orders until a price tick fills, or their owner cancels, them."""
+    key = "id SERIAL PRIMARY KEY" if dialect == "postgresql" else "id integer PRIMARY KEY AUTOINCREMENT NOT NULL"
+    db.execute(f"CREATE TABLE open_orders ({key}, user_id integer NOT NULL REFERENCES users (id), Symbol text NOT NULL, "
+               "Side text NOT NULL, Kind text NOT NULL, Shares integer NOT NULL, TriggerPrice numeric NOT NULL, "
+               "Placed timestamp NOT NULL, Status text NOT NULL DEFAULT 'open', Filled timestamp, FillPrice numeric)")
+    db.execute("CREATE INDEX open_orders_status ON open_orders (Status, id)")
+    db.execute("CREATE INDEX open_orders_user ON open_orders (user_id, Status)")
+
+
+def _price_bars(db, dialect):
+    """Keep 1-minute and 1-day OHLC bars of every fetched quote, clustered on SQLite by symbol, period and start."""
+    clustered = "" if dialect == "postgresql" else " WITHOUT ROWID"
+    db.execute("CREATE TABLE bars (Symbol text NOT NULL, Period integer NOT NULL, Start integer NOT NULL, "
+               "Open integer NOT NULL, High integer NOT NULL, Low integer NOT NULL, Close integer NOT NULL, Ticks integer NOT NULL, "
+               f"PRIMARY KEY (Symbol, Period, Start)){clustered}")
+
+
+def _replayed_cost_basis(db, dialect):
+    """
+    Replace positions carried over from before the cost ledger, whose Cost is their last market
+    value, with what each user's history adds up to. A frozen copy of orders.rebuild_positions
+    as of this version, so later changes to it can't change what this migration does.
+    """
+    db.execute("UPDATE users SET version = version + 1 WHERE id IN (SELECT user_id FROM purchases) OR id IN (SELECT user_id FROM history)")
+    db.execute("DELETE FROM purchases")
+    for user in db.execute("SELECT DISTINCT user_id FROM history WHERE user_id IS NOT NULL"):
+        positions = {}
+        for trade in db.execute("SELECT Symbol, Shares, Price, [Transaction] FROM history WHERE user_id = ? ORDER BY Date, id",
+                                user["user_id"]):
+            shares, cost, realized = positions.get(trade["Symbol"], (0, 0, 0))
+            amount = trade["Shares"] * float(trade["Price"])
+            if trade["Transaction"] == "Purchase":
+                shares, cost = shares + trade["Shares"], cost + amount
+            elif shares:
+                released = cost * min(trade["Shares"], shares) / shares
+                shares, cost, realized = max(shares - trade["Shares"], 0), cost - released, realized + amount - released
+            positions[trade["Symbol"]] = (shares, cost, realized)
+        for symbol, (shares, cost, realized) in positions.items():
+            db.execute("INSERT INTO purchases (user_id, Symbol, Shares, Cost, Realized) VALUES (?, ?, ?, ?, ?)",
+                       user["user_id"], symbol, shares, round(cost, 2), round(realized, 2))
+
+
+def _order_closures(db, dialect):
+    """Number orders as they're cancelled, filled or rejected, so books can follow closures instead of rescanning open orders."""
+    db.execute("ALTER TABLE open_orders ADD COLUMN ClosedSeq integer")
+    db.execute("CREATE INDEX open_orders_closed ON open_orders (ClosedSeq)")
+
+
+# Ordered (version, migration) pairs; never edit or renumber one that has shipped
+MIGRATIONS = [
+    (1, _prices_table),
+    (2, _history_surrogate_key),
+    (3, _lookup_indexes),
+    (4, _user_id_keys),
+    (5, _portfolio_version),
+    (6, _realized_gains),
+    (7, _open_orders),
+    (8, _price_bars),
+    (9, _replayed_cost_basis),
+    (10, _order_closures),
+]
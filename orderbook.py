@@ -0,0 +1,116 @@
+'''
+In-memory book of resting limit and stop orders.
+
+Each symbol keeps two heaps: orders that trigger when the price falls to
+their trigger (buy limits and sell stops), highest trigger on top, and
+orders that trigger when it rises to theirs (sell limits and buy stops),
+lowest trigger on top. A tick pops only the orders it triggers, so each
+costs O(log n) however many orders are resting.
+
+The open_orders table is the source of truth. OrderBook.sync loads orders
+placed since the last sync, from any process, by id, and drops those
+cancelled or filled elsewhere in the meantime by the sequence number each
+order is given as it closes, so neither needs a scan of every open order.
+'''
+
+import heapq
+import threading
+
+from collections import defaultdict
+
+# Ids, and closure numbers, below the newest seen that sync looks at again, for
+# orders whose numbers were allocated before it but which committed after it
+SYNC_OVERLAP = 100
+
+
+def falls_to(side, kind):
+    """Return whether an order triggers when the price falls to its trigger, rather than rises to it."""
+    return (side, kind) in (("buy", "limit"), ("sell", "stop"))
+
+
+class OrderBook:
+    """Resting orders by symbol, ordered by trigger price."""
+
+    def __init__(self):
+        self._falling = defaultdict(list)
+        self._rising = defaultdict(list)
+        self._orders = {}
+        self._last_id = 0
+        self._last_closed = None
+        self._lock = threading.Lock()
+
+    def add(self, order):
+        """Rest an order, a row of open_orders."""
+        with self._lock:
+            self._add(order)
+
+    def _add(self, order):
+        if order["id"] in self._orders:
+            return
+        self._orders[order["id"]] = order
+        self._last_id = max(self._last_id, order["id"])
+        trigger = float(order["TriggerPrice"])
+        if falls_to(order["Side"], order["Kind"]):
+            heapq.heappush(self._falling[order["Symbol"]], (-trigger, order["id"]))
+        else:
+            heapq.heappush(self._rising[order["Symbol"]], (trigger, order["id"]))
+
+    def sync(self, db):
+        """Add orders placed, and drop orders closed, since the last sync, returning how many were added."""
+        with self._lock:
+            # Forget orders cancelled or filled by another process, so their symbols stop being refreshed;
+            # the first sync only notes where closures are up to, since it loads nothing but open orders
+            if self._last_closed is None:
+                self._last_closed = db.execute("SELECT COALESCE(MAX(ClosedSeq), 0) AS seq FROM open_orders")[0]["seq"]
+            else:
+                rows = db.execute("SELECT id, Symbol, ClosedSeq FROM open_orders WHERE ClosedSeq > ? ORDER BY ClosedSeq",
+                                  self._last_closed - SYNC_OVERLAP)
+                closed = {row["Symbol"] for row in rows if self._orders.pop(row["id"], None)}
+                for symbol in closed:
+                    self._rebuild(symbol)
+                if rows:
+                    self._last_closed = max(self._last_closed, rows[-1]["ClosedSeq"])
+
+            rows = db.execute("SELECT * FROM open_orders WHERE Status = 'open' AND id > ? ORDER BY id", self._last_id - SYNC_OVERLAP)
+            before = len(self._orders)
+            for row in rows:
+                self._add(row)
+            return len(self._orders) - before
+
+    def _rebuild(self, symbol):
+        """Rebuild symbol's heaps from its tracked orders, dropping entries of orders no longer tracked."""
+        orders = [order for order in self._orders.values() if order["Symbol"] == symbol]
+        self._falling.pop(symbol, None)
+        self._rising.pop(symbol, None)
+        for order in orders:
+            del self._orders[order["id"]]
+            self._add(order)
+
+    def discard(self, order_id):
+        """Stop tracking an order; its heap entry is skipped when reached."""
+        with self._lock:
+            self._orders.pop(order_id, None)
+
+    def symbols(self):
+        """Return symbols with resting orders."""
+        with self._lock:
+            return {order["Symbol"] for order in self._orders.values()}
+
+    def triggered(self, symbol, price):
+        """Remove and return the orders for symbol that a tick at price triggers, oldest first."""
+        orders = []
+        with self._lock:
+            falling, rising = self._falling.get(symbol), self._rising.get(symbol)
+            while falling and -falling[0][0] >= price:
+                orders.append(heapq.heappop(falling)[1])
+            while rising and rising[0][0] <= price:
+                orders.append(heapq.heappop(rising)[1])
+            orders = [self._orders.pop(order_id) for order_id in sorted(orders) if order_id in self._orders]
+        return orders
+
+    def __len__(self):
+        return len(self._orders)
+
+
+# Shared by every thread of this process
+book = OrderBook()
@@ -0,0 +1,204 @@
+from time import gmtime, strftime
+
+from helpers import save_prices, transaction
+from orderbook import book
+
+
+# Stamps an order leaving the open state with the next closure number, which OrderBook.sync follows
+# to drop orders closed by other processes without looking at every open order
+_CLOSE = "ClosedSeq = (SELECT COALESCE(MAX(ClosedSeq), 0) + 1 FROM open_orders)"
+
+
+class OrderError(Exception):
+    """Raised when an order can't be executed, with a message fit to show the user."""
+
+
+def buy(db, user_id, stock, shares):
+    """Buy shares of stock for the user at its quoted price in a single transaction, returning the cost."""
+    with transaction(db):
+        return _buy(db, user_id, stock, shares)
+
+
+def sell(db, user_id, stock, shares):
+    """Sell shares of stock for the user at its quoted price in a single transaction, returning the proceeds."""
+    with transaction(db):
+        return _sell(db, user_id, stock, shares)
+
+
+def basket(db, user_id, legs):
+    """
+    Execute legs, (side, stock, shares) tuples with at most one per symbol, at their quoted prices
+    in a single transaction, returning the net change in cash. Sales fund purchases, and if the user
+    can't afford or cover every leg none is executed.
+    """
+    symbols = [stock["symbol"] for _, stock, _ in legs]
+    if len(set(symbols)) < len(symbols):
+        raise OrderError("each symbol may appear only once in a basket")
+    trades = []
+    for side, stock, shares in legs:
+        price = round(float(stock["price"]), 2)
+        trades.append((side, stock, shares, price, round(shares * price, 2)))
+    net = round(sum(amount if side == "sell" else -amount for side, _, _, _, amount in trades), 2)
+
+    with transaction(db):
+        # Check every leg against the user's cash and holdings before changing anything
+        cash = float(db.execute("SELECT cash FROM users WHERE id = ?", user_id)[0]["cash"])
+        if cash + net < 0:
+            raise OrderError("can't afford")
+        sold = [stock["symbol"] for side, stock, _, _, _ in trades if side == "sell"]
+        owned = {}
+        if sold:
+            owned = {row["Symbol"]: row["Shares"] for row in db.execute(
+                f"SELECT Symbol, Shares FROM purchases WHERE user_id = ? AND Symbol IN ({', '.join('?' * len(sold))})", user_id, *sold)}
+        for side, stock, shares, _, _ in trades:
+            if side == "sell" and owned.get(stock["symbol"], 0) < shares:
+                raise OrderError(f"You don't own {shares} shares of {stock['symbol']}!")
+
+        # Settle cash once for the whole basket, guarding against trades made since the check
+        if not db.execute("UPDATE users SET cash = cash + ?, version = version + 1 WHERE id = ? AND cash + ? >= 0", net, user_id, net):
+            raise OrderError("can't afford")
+        _add_positions(db, user_id, [(stock["symbol"], shares, amount) for side, stock, shares, _, amount in trades if side == "buy"])
+        for side, stock, shares, _, amount in trades:
+            if side == "sell":
+                _release_position(db, user_id, stock["symbol"], shares, amount)
+        _record(db, user_id, [(stock, shares, price, "Purchase" if side == "buy" else "Sale") for side, stock, shares, price, _ in trades])
+    return net
+
+
+def place(db, user_id, side, kind, stock, shares, trigger):
+    """Rest a limit or stop order for the user until a price tick triggers it, returning its id.
+
+    The order joins the book of whichever process refreshes prices on its next sync.
+    """
+    if (side, kind) not in _TRIGGERS:
+        raise OrderError("order must be a buy or sell limit or stop")
+    return db.execute("INSERT INTO open_orders (user_id, Symbol, Side, Kind, Shares, TriggerPrice, Placed) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id",
+                      user_id, stock["symbol"], side, kind, shares, round(float(trigger), 2), strftime("%Y-%m-%d %H:%M:%S", gmtime()))[0]["id"]
+
+
+def cancel(db, user_id, order_id):
+    """Cancel the user's open order, returning whether there was one to cancel."""
+    if not db.execute(f"UPDATE open_orders SET Status = 'cancelled', {_CLOSE} WHERE id = ? AND user_id = ? AND Status = 'open'",
+                      order_id, user_id):
+        return False
+    book.discard(order_id)
+    return True
+
+
+def cancel_all(db, user_id):
+    """Cancel every open order of the user, returning how many there were."""
+    return db.execute(f"UPDATE open_orders SET Status = 'cancelled', {_CLOSE} WHERE user_id = ? AND Status = 'open'", user_id)
+
+
+def fill_triggered(db, quotes):
+    """Execute resting orders triggered by quotes at the quoted price, returning how many were filled."""
+    filled = 0
+    for stock in quotes:
+        if not stock or stock.get("stale"):
+            continue
+        triggered = book.triggered(stock["symbol"], float(stock["price"]))
+        for i, order in enumerate(triggered):
+            try:
+                with transaction(db):
+                    # Claim the order, so one cancelled or filled by another process isn't executed again
+                    if not db.execute(f"UPDATE open_orders SET Status = 'filled', Filled = ?, FillPrice = ?, {_CLOSE} WHERE id = ? AND Status = 'open'",
+                                      strftime("%Y-%m-%d %H:%M:%S", gmtime()), round(float(stock["price"]), 2), order["id"]):
+                        continue
+                    _TRIGGERS[order["Side"], order["Kind"]](db, order["user_id"], stock, order["Shares"])
+                filled += 1
+            except OrderError:
+                db.execute(f"UPDATE open_orders SET Status = 'rejected', {_CLOSE} WHERE id = ? AND Status = 'open'", order["id"])
+            except Exception:
+                # Rest this order and the rest of the batch again, so a later tick retries them
+                for order in triggered[i:]:
+                    book.add(order)
+                raise
+    return filled
+
+
+def _buy(db, user_id, stock, shares):
+    price = round(float(stock["price"]), 2)
+    cost = round(shares * price, 2)
+
+    # Deduct cash only if there's enough of it, so concurrent orders can't overdraw
+    if not db.execute("UPDATE users SET cash = cash - ?, version = version + 1 WHERE id = ? AND cash >= ?", cost, user_id, cost):
+        raise OrderError("can't afford")
+
+    _add_positions(db, user_id, [(stock["symbol"], shares, cost)])
+    _record(db, user_id, [(stock, shares, price, "Purchase")])
+    return cost
+
+
+def _sell(db, user_id, stock, shares):
+    price = round(float(stock["price"]), 2)
+    proceeds = round(shares * price, 2)
+
+    _release_position(db, user_id, stock["symbol"], shares, proceeds)
+    db.execute("UPDATE users SET cash = cash + ?, version = version + 1 WHERE id = ?", proceeds, user_id)
+    _record(db, user_id, [(stock, shares, price, "Sale")])
+    return proceeds
+
+
+def _add_positions(db, user_id, purchases):
+    """Add (symbol, shares, cost) purchases to the user's positions, creating them if needed."""
+    if not purchases:
+        return
+    db.execute("INSERT INTO purchases (user_id, Symbol, Shares, Cost) VALUES " + ", ".join(["(?, ?, ?, ?)"] * len(purchases)) +
+               " ON CONFLICT (user_id, Symbol) DO UPDATE SET Shares = purchases.Shares + excluded.Shares, Cost = purchases.Cost + excluded.Cost",
+               *[value for purchase in purchases for value in (user_id, *purchase)])
+
+
+def _release_position(db, user_id, symbol, shares, proceeds):
+    """Remove sold shares from the user's position, raising OrderError if the user doesn't own enough."""
+
+    # Release the sold shares' part of the cost basis at average cost and book the difference from the
+    # proceeds as realized gain; the position is kept at zero shares so its realized gain survives
+    # (1.0 * keeps SQLite from dividing integer costs as integers)
+    if not db.execute("UPDATE purchases SET Shares = Shares - ?, Cost = 1.0 * Cost * (Shares - ?) / Shares, "
+                      "Realized = Realized + ? - 1.0 * Cost * ? / Shares "
+                      "WHERE user_id = ? AND Symbol = ? AND Shares >= ?",
+                      shares, shares, proceeds, shares, user_id, symbol, shares):
+        raise OrderError("You don't own that many shares of the company!")
+
+
+# How each kind of resting order executes once triggered
+_TRIGGERS = {
+    ("buy", "limit"): _buy,
+    ("buy", "stop"): _buy,
+    ("sell", "limit"): _sell,
+    ("sell", "stop"): _sell,
+}
+
+
+def rebuild_positions(db):
+    """Regenerate every user's positions by replaying their history, returning how many were written."""
+    count = 0
+    with transaction(db):
+        # Let clients and the analytics cache of every affected user see the rebuilt positions
+        db.execute("UPDATE users SET version = version + 1 WHERE id IN (SELECT user_id FROM purchases) OR id IN (SELECT user_id FROM history)")
+        db.execute("DELETE FROM purchases")
+        for user in db.execute("SELECT DISTINCT user_id FROM history WHERE user_id IS NOT NULL"):
+            positions = {}
+            for trade in db.execute("SELECT Symbol, Shares, Price, [Transaction] FROM history WHERE user_id = ? ORDER BY Date, id",
+                                    user["user_id"]):
+                shares, cost, realized = positions.get(trade["Symbol"], (0, 0, 0))
+                amount = trade["Shares"] * float(trade["Price"])
+                if trade["Transaction"] == "Purchase":
+                    shares, cost = shares + trade["Shares"], cost + amount
+                elif shares:
+                    released = cost * min(trade["Shares"], shares) / shares
+                    shares, cost, realized = max(shares - trade["Shares"], 0), cost - released, realized + amount - released
+                positions[trade["Symbol"]] = (shares, cost, realized)
+            for symbol, (shares, cost, realized) in positions.items():
+                db.execute("INSERT INTO purchases (user_id, Symbol, Shares, Cost, Realized) VALUES (?, ?, ?, ?, ?)",
+                           user["user_id"], symbol, shares, round(cost, 2), round(realized, 2))
+                count += 1
+    return count
+
+
+def _record(db, user_id, trades):
+    """Add (stock, shares, price, kind) trades to history in one statement and keep their prices as the latest."""
+    date = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+    db.execute("INSERT INTO history(Date, user_id, Symbol, Shares, Price, [Transaction]) VALUES " + ", ".join(["(?, ?, ?, ?, ?, ?)"] * len(trades)),
+               *[value for stock, shares, price, kind in trades for value in (date, user_id, stock["symbol"], shares, price, kind)])
+    save_prices(db, [stock for stock, _, _, _ in trades])
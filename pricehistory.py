@@ -0,0 +1,114 @@
+'''
+Price history as OHLC bars of every quote fetched from the provider.
+
+Quotes are folded into 1-minute and 1-day bars in memory as they arrive,
+and a thread writes them every PRICE_HISTORY_FLUSH_INTERVAL seconds,
+merging each with whatever other processes wrote for the same bar. Bars
+of a process that exits before its next flush are lost.
+
+The bars table is keyed, and on SQLite clustered, by (Symbol, Period,
+Start), so a chart's range is one index scan. Starts are Unix seconds and
+prices are whole cents, which SQLite stores in as few bytes as they need.
+'''
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds covered by each bar, by name
+PERIODS = {"1m": 60, "1d": 24 * 60 * 60}
+
+# Most bars written by a single upsert, keeping well under SQLite's bound parameter limit
+BAR_BATCH_SIZE = 100
+
+
+class BarRecorder:
+    """Bars not yet written, by (symbol, period, start)."""
+
+    def __init__(self):
+        self._bars = {}
+        self._lock = threading.Lock()
+
+    def record(self, quotes):
+        """Fold quotes, fetched just now, into the open bars of their symbols."""
+        now = int(time.time())
+        with self._lock:
+            for quote in quotes:
+                if not quote or quote.get("stale"):
+                    continue
+                cents = round(float(quote["price"]) * 100)
+                for seconds in PERIODS.values():
+                    key = (quote["symbol"], seconds, now - now % seconds)
+                    bar = self._bars.get(key)
+                    if bar is None:
+                        self._bars[key] = [cents, cents, cents, cents, 1]
+                    else:
+                        bar[1] = max(bar[1], cents)
+                        bar[2] = min(bar[2], cents)
+                        bar[3] = cents
+                        bar[4] += 1
+
+    def flush(self, db):
+        """Write the bars recorded since the last flush, returning how many were written, or keeping them if that fails."""
+        with self._lock:
+            bars, self._bars = self._bars, {}
+        rows = [(*key, *bar) for key, bar in bars.items()]
+        written = 0
+
+        try:
+            # Keep the first open and extend the range of a bar another process has already written
+            greatest, least = ("GREATEST", "LEAST") if db.dialect == "postgresql" else ("MAX", "MIN")
+            for i in range(0, len(rows), BAR_BATCH_SIZE):
+                batch = rows[i:i + BAR_BATCH_SIZE]
+                db.execute("INSERT INTO bars (Symbol, Period, Start, Open, High, Low, Close, Ticks) VALUES " +
+                           ", ".join(["(?, ?, ?, ?, ?, ?, ?, ?)"] * len(batch)) +
+                           f" ON CONFLICT (Symbol, Period, Start) DO UPDATE SET High = {greatest}(bars.High, excluded.High), "
+                           f"Low = {least}(bars.Low, excluded.Low), Close = excluded.Close, Ticks = bars.Ticks + excluded.Ticks",
+                           *[value for row in batch for value in row])
+                written += len(batch)
+        except Exception:
+            # Fold the bars of this and later batches back in, behind any recorded since, so the next flush retries them
+            with self._lock:
+                for key, bar in list(bars.items())[written:]:
+                    newer = self._bars.get(key)
+                    if newer is None:
+                        self._bars[key] = bar
+                    else:
+                        self._bars[key] = [bar[0], max(bar[1], newer[1]), min(bar[2], newer[2]), newer[3], bar[4] + newer[4]]
+            raise
+        return len(rows)
+
+
+def bars(db, symbols, period, start, end):
+    """Return each symbol's bars of period seconds starting in [start, end), oldest first, as [start, open, high, low, close] lists."""
+    result = {symbol: [] for symbol in symbols}
+    if not symbols:
+        return result
+    placeholders = ", ".join("?" * len(symbols))
+    for row in db.execute(f"SELECT Symbol, Start, Open, High, Low, Close FROM bars WHERE Symbol IN ({placeholders}) "
+                          "AND Period = ? AND Start >= ? AND Start < ? ORDER BY Symbol, Start", *symbols, period, start, end):
+        result[row["Symbol"]].append([row["Start"], row["Open"] / 100, row["High"] / 100, row["Low"] / 100, row["Close"] / 100])
+    return result
+
+
+def run(db, interval, stop=None):
+    """Flush recorded bars every interval seconds until stop is set."""
+    stop = stop or threading.Event()
+    while not stop.wait(interval):
+        try:
+            recorder.flush(db)
+        except Exception:
+            logger.exception("price history flush failed")
+
+
+def start(db, interval):
+    """Flush recorded bars from a daemon thread of the current process."""
+    thread = threading.Thread(target=run, args=(db, interval), name="price-history", daemon=True)
+    thread.start()
+    return thread
+
+
+# Shared by every thread of this process
+recorder = BarRecorder()
@@ -0,0 +1,388 @@
+'''
+Market-data providers behind helpers.lookup, chosen with QUOTE_PROVIDER:
+
+    iex        live quotes from IEX Cloud (needs API_KEY)
+    replay     ticks replayed from QUOTE_REPLAY_FILE (CSV, or Parquet with pandas)
+    synthetic  deterministic made-up prices, for offline load tests
+
+Every provider returns quotes as {"name", "price", "symbol"} dicts, None
+for unknown symbols, and raises one of PROVIDER_ERRORS when it can't be
+reached.
+'''
+
+import asyncio
+import csv
+import httpx
+import math
+import os
+import re
+import requests
+import threading
+import time
+import urllib.parse
+import zlib
+
+from collections import defaultdict
+from itertools import cycle
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ratelimit import Budget
+
+
+class ProviderUnavailable(requests.RequestException):
+    """Raised without contacting the provider while the circuit breaker is open or the budget is spent."""
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing provider for a while.
+
+    After `threshold` consecutive failures the breaker opens and callers
+    fail fast for `reset_timeout` seconds, after which a single trial call
+    is let through to probe whether the provider has recovered.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a call may be made now."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this call probe, keep failing fast for everyone else
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+# Provider responses worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class QuoteClient:
+    """
+    HTTP client for the quote provider.
+
+    Reuses pooled keep-alive connections, bounds every call with connect and
+    read timeouts, retries transient failures with backoff and trips a
+    circuit breaker when the provider keeps failing. With a budget, calls
+    beyond it fail fast, like those made while the breaker is open.
+    """
+
+    def __init__(self, base_url, api_key, timeout=(3.05, 5), retries=2, backoff=0.3,
+                 pool_size=10, breaker=None, budget=None):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.budget = budget
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=Retry(
+            total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+            allowed_methods=("GET",)))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, cost=1, **params):
+        """GET path from the provider, spending cost calls of the budget, raising requests.RequestException on failure."""
+        self.check(cost)
+        try:
+            response = self.session.get(f"{self.base_url}{path}", params=dict(params, token=self.api_key),
+                                        timeout=self.timeout)
+            if response.status_code >= 500:
+                response.raise_for_status()
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return response
+
+    def check(self, cost):
+        """Raise ProviderUnavailable if a call costing cost mustn't be made now."""
+        if not self.breaker.allow():
+            raise ProviderUnavailable("quote provider circuit open")
+        if self.budget and not self.budget.spend(cost):
+            raise ProviderUnavailable("quote provider budget spent")
+
+    def degraded(self):
+        """Return whether calls are currently failing fast."""
+        return self.breaker.is_open() or bool(self.budget and self.budget.is_spent())
+
+
+class AsyncQuoteClient:
+    """
+    Asyncio counterpart of QuoteClient, for lookups made on an event loop.
+
+    Shares the settings and circuit breaker of the synchronous client, so
+    both back off together when the provider is degraded.
+    """
+
+    def __init__(self, client, max_connections=100):
+        self.client = client
+        self.max_connections = max_connections
+        self._http = None
+
+    def _session(self):
+        # Created on first use so it binds to the running event loop
+        if self._http is None:
+            connect, read = self.client.timeout
+            self._http = httpx.AsyncClient(base_url=self.client.base_url,
+                                           timeout=httpx.Timeout(read, connect=connect),
+                                           limits=httpx.Limits(max_connections=self.max_connections))
+        return self._http
+
+    async def get(self, path, cost=1, **params):
+        """GET path from the provider, raising httpx.HTTPError or ProviderUnavailable on failure."""
+        client = self.client
+        client.check(cost)
+        try:
+            for attempt in range(client.retries + 1):
+                if attempt:
+                    await asyncio.sleep(client.backoff * 2 ** (attempt - 1))
+                try:
+                    response = await self._session().get(path, params=dict(params, token=client.api_key))
+                except httpx.TransportError:
+                    if attempt == client.retries:
+                        raise
+                    continue
+                if response.status_code not in RETRY_STATUSES:
+                    break
+            if response.status_code in RETRY_STATUSES or response.status_code >= 500:
+                response.raise_for_status()
+        except httpx.HTTPError:
+            client.breaker.record_failure()
+            raise
+        client.breaker.record_success()
+        return response
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+# Failures a provider may raise when it can't be reached
+PROVIDER_ERRORS = (requests.RequestException, httpx.HTTPError)
+
+
+class Provider:
+    """
+    Source of quotes.
+
+    Subclasses implement quote and may override quotes when they can fetch
+    several symbols in one round trip, and aquote when they can avoid
+    blocking the event loop.
+    """
+
+    # Most symbols passed to quotes at once
+    batch_size = 100
+
+    def quote(self, symbol):
+        """Return quote for an upper-cased symbol, or None if unknown."""
+        raise NotImplementedError
+
+    def quotes(self, symbols):
+        """Return a dict of symbol to quote for symbols, omitting unknown symbols."""
+        quotes = {}
+        for symbol in symbols:
+            quote = self.quote(symbol)
+            if quote:
+                quotes[symbol] = quote
+        return quotes
+
+    async def aquote(self, symbol):
+        """Return quote for symbol from an event loop."""
+        return self.quote(symbol)
+
+    def degraded(self):
+        """Return whether calls are currently failing fast."""
+        return False
+
+
+class IEXProvider(Provider):
+    """Live quotes from IEX Cloud."""
+
+    def __init__(self, client, async_client):
+        self.client = client
+        self.async_client = async_client
+
+    def quote(self, symbol):
+
+        # Contact API
+        response = self.client.get(f"/stock/{urllib.parse.quote_plus(symbol)}/quote")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        # Parse response
+        try:
+            return _parse_quote(response.json())
+        except ValueError:
+            return None
+
+    def quotes(self, symbols):
+
+        # Contact API
+        response = self.client.get("/stock/market/batch", cost=len(symbols), symbols=",".join(symbols), types="quote")
+        response.raise_for_status()
+
+        # Parse response, which is keyed by symbol
+        try:
+            quotes = {}
+            for symbol, item in response.json().items():
+                quote = _parse_quote(item.get("quote"))
+                if quote:
+                    quotes[symbol.upper()] = quote
+            return quotes
+        except (AttributeError, TypeError, ValueError):
+            raise requests.RequestException("malformed batch response")
+
+    async def aquote(self, symbol):
+
+        # Contact API
+        response = await self.async_client.get(f"/stock/{urllib.parse.quote_plus(symbol)}/quote")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+
+        # Parse response
+        try:
+            return _parse_quote(response.json())
+        except ValueError:
+            return None
+
+    def degraded(self):
+        return self.client.degraded()
+
+
+class ReplayProvider(Provider):
+    """
+    Quotes replayed from recorded ticks.
+
+    The file has symbol and price columns and optionally name; each lookup
+    of a symbol returns its next tick, wrapping around at the end.
+    """
+
+    def __init__(self, path):
+        ticks = defaultdict(list)
+        for row in _read_ticks(path):
+            try:
+                symbol = str(row["symbol"]).strip().upper()
+                ticks[symbol].append({
+                    "name": row.get("name") or symbol,
+                    "price": float(row["price"]),
+                    "symbol": symbol
+                })
+            except (KeyError, TypeError, ValueError):
+                raise RuntimeError(f"malformed tick in {path}: {row}")
+        self._ticks = {symbol: cycle(quotes) for symbol, quotes in ticks.items()}
+        self._lock = threading.Lock()
+
+    def quote(self, symbol):
+        ticks = self._ticks.get(symbol)
+        if ticks is None:
+            return None
+        with self._lock:
+            return dict(next(ticks))
+
+
+class SyntheticProvider(Provider):
+    """
+    Made-up prices that need no network or data files.
+
+    Any 1-5 letter symbol is known. Its price drifts smoothly around a base
+    derived from the symbol and changes every `interval` seconds, so every
+    process sees the same price for a symbol at the same time.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, interval=1):
+        self.interval = interval
+
+    def quote(self, symbol):
+        if not SYNTHETIC_SYMBOL.match(symbol):
+            return None
+        seed = zlib.crc32(symbol.encode())
+        base = 10 + seed % 490
+        tick = int(time.time() // self.interval)
+        price = base * (1 + 0.05 * math.sin(tick / 60 + seed))
+        return {"name": f"{symbol} Inc.", "price": round(price, 2), "symbol": symbol}
+
+
+# Symbols SyntheticProvider knows
+SYNTHETIC_SYMBOL = re.compile(r"^[A-Z]{1,5}$")
+
+
+def create_provider(name):
+    """Return the provider called name, configured from the environment."""
+    if name == "iex":
+        client = QuoteClient(os.environ.get("IEX_BASE_URL", "https://cloud.iexapis.com/stable"),
+                             os.environ.get("API_KEY"),
+                             timeout=(float(os.environ.get("QUOTE_CONNECT_TIMEOUT", 3.05)),
+                                      float(os.environ.get("QUOTE_READ_TIMEOUT", 5))),
+                             retries=int(os.environ.get("QUOTE_RETRIES", 2)),
+                             breaker=CircuitBreaker(threshold=int(os.environ.get("QUOTE_BREAKER_THRESHOLD", 5)),
+                                                    reset_timeout=float(os.environ.get("QUOTE_BREAKER_RESET", 30))))
+
+        # Optionally cap upstream calls, shared by every process when rate limits are kept in Redis
+        if os.environ.get("QUOTE_BUDGET_RATE"):
+            rate = float(os.environ["QUOTE_BUDGET_RATE"])
+            client.budget = Budget(rate, float(os.environ.get("QUOTE_BUDGET_BURST", rate * 60)))
+        return IEXProvider(client, AsyncQuoteClient(client, max_connections=int(os.environ.get("ASYNC_QUOTE_CONNECTIONS", 100))))
+    if name == "replay":
+        if not os.environ.get("QUOTE_REPLAY_FILE"):
+            raise RuntimeError("QUOTE_REPLAY_FILE not set")
+        return ReplayProvider(os.environ["QUOTE_REPLAY_FILE"])
+    if name == "synthetic":
+        return SyntheticProvider(float(os.environ.get("QUOTE_SYNTHETIC_INTERVAL", 1)))
+    raise RuntimeError(f"unknown QUOTE_PROVIDER: {name}")
+
+
+def _parse_quote(quote):
+    """Convert IEX quote JSON to the dict returned by lookup, or None if malformed."""
+    try:
+        return {
+            "name": quote["companyName"],
+            "price": float(quote["latestPrice"]),
+            "symbol": quote["symbol"]
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _read_ticks(path):
+    """Yield rows of a CSV or Parquet tick file as dicts."""
+    if path.endswith(".parquet"):
+        try:
+            import pandas
+        except ImportError:
+            raise RuntimeError("pandas is required to replay Parquet files")
+        yield from pandas.read_parquet(path).to_dict("records")
+    else:
+        with open(path, newline="") as file:
+            yield from csv.DictReader(file)
@@ -0,0 +1,100 @@
+'''
+Token-bucket rate limiting.
+
+Every bucket holds up to `burst` tokens and refills at `rate` tokens a
+second; a call takes a token or is refused until one is due. Buckets live
+in the backend chosen with RATE_LIMIT_BACKEND: "memory" keeps them in
+this process, "redis" shares them between every process using REDIS_URL,
+and "off" disables per-route limits (see helpers.rate_limit).
+'''
+
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    """Buckets in this process, forgetting the least recently used beyond maxsize."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        """Take cost tokens from key's bucket, returning 0 if they were there or else seconds until they will be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBackend:
+    """Buckets in Redis, updated atomically so every process shares them."""
+
+    SCRIPT = """
+        local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local clock = redis.call("TIME")
+        local now = clock[1] + clock[2] / 1000000
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+        local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + (now - (tonumber(bucket[2]) or now)) * rate)
+        local wait = 0
+        if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+        redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+        redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, client, prefix="ratelimit:"):
+        self.prefix = prefix
+        self._script = client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst, cost=1):
+        return float(self._script(keys=[self.prefix + key], args=[rate, burst, cost]))
+
+
+def create_backend(name):
+    """Return the backend called name, or None for "off"."""
+    if name == "memory":
+        return MemoryBackend()
+    if name == "redis":
+        import redis
+        return RedisBackend(redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379")))
+    if name == "off":
+        return None
+    raise RuntimeError(f"unknown RATE_LIMIT_BACKEND: {name}")
+
+
+# Shared by every request handled by this process
+backend = create_backend(os.environ.get("RATE_LIMIT_BACKEND", "memory"))
+
+
+class Budget:
+    """Global allowance of upstream calls, refilling at rate a second up to burst."""
+
+    def __init__(self, rate, burst, key="upstream"):
+        self.rate = rate
+        self.burst = burst
+        self.key = key
+        self.backend = backend or MemoryBackend()
+        self.spent_until = 0
+
+    def spend(self, cost=1):
+        """Return whether cost calls may be made now, remembering when the budget will allow them if not."""
+        wait = self.backend.take(self.key, self.rate, self.burst, min(cost, self.burst))
+        if wait:
+            self.spent_until = time.monotonic() + wait
+        return not wait
+
+    def is_spent(self):
+        return time.monotonic() < self.spent_until
@@ -0,0 +1,61 @@
+import logging
+import os
+import threading
+import time
+
+import orders
+from helpers import lookup_many, save_prices, transaction
+from orderbook import book
+
+logger = logging.getLogger(__name__)
+
+# Symbols fetched and stored per round trip
+REFRESH_BATCH_SIZE = int(os.environ.get("PRICE_REFRESH_BATCH_SIZE", 100))
+
+
+def refresh_prices(db, batch_size=REFRESH_BATCH_SIZE):
+    """
+    Store the latest price of every symbol held by any user or with resting orders,
+    filling the orders each price triggers, and return how many symbols were refreshed.
+    """
+
+    # Upstream calls scale with distinct symbols, not with users holding them
+    book.sync(db)
+    symbols = sorted({row["Symbol"] for row in db.execute("SELECT DISTINCT Symbol FROM purchases WHERE Shares > 0")} | book.symbols())
+
+    for i in range(0, len(symbols), batch_size):
+        quotes = lookup_many(symbols[i:i + batch_size])
+        with transaction(db):
+            save_prices(db, quotes.values())
+        filled = orders.fill_triggered(db, quotes.values())
+        if filled:
+            logger.info("filled %d resting orders", filled)
+    return len(symbols)
+
+
+def run(db, interval, stop=None):
+    """Refresh prices every interval seconds until stop is set."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            count = refresh_prices(db)
+            logger.info("refreshed %d symbols in %.2fs", count, time.monotonic() - started)
+        except Exception:
+            logger.exception("price refresh failed")
+        stop.wait(max(0, interval - (time.monotonic() - started)))
+
+
+def start(db, interval):
+    """Run the refresher in a daemon thread of the current process."""
+    thread = threading.Thread(target=run, args=(db, interval), name="price-refresher", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    # Run as a standalone worker process (see Procfile)
+    from application import db
+
+    logging.basicConfig(level=logging.INFO)
+    run(db, float(os.environ.get("PRICE_REFRESH_INTERVAL", 60)))